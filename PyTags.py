@@ -1,18 +1,22 @@
 from __future__ import division
 
+import fnmatch
 import os
 import os.path
 import re
 
+from itertools import count
 from operator import eq as op_eq, ne as op_ne
+from time import time
 
 from sublime import ENCODED_POSITION, INHIBIT_EXPLICIT_COMPLETIONS, \
     INHIBIT_WORD_COMPLETIONS, OP_EQUAL, OP_NOT_EQUAL, message_dialog, \
-    status_message
-from sublime_plugin import EventListener, TextCommand
+    set_timeout, status_message
+from sublime_plugin import EventListener, TextCommand, WindowCommand
 
-from pytags.async import async_worker, ui_worker
-from pytags.lpc.client import LPCClient
+from pytags.async import PRIORITY_BACKGROUND, PRIORITY_INTERACTIVE, \
+    async_worker, ui_worker
+from pytags.lpc.client import LATENCY_BUCKETS, LPCClient
 
 
 def get_module_name(view, pos):
@@ -30,16 +34,91 @@ def is_python_source_file(file_name):
     return file_name.endswith('.py') or file_name.endswith('.pyw')
 
 
+# Names of directories that are not indexed, unless database definition has
+# its own "exclude" list.
+DEFAULT_EXCLUDE = ['.git', '.hg', '.svn', '.bzr', '.tox', '__pycache__',
+                   'node_modules', '*.egg-info']
+
+
+def get_exclude(database):
+    return database.get('exclude', DEFAULT_EXCLUDE)
+
+
+def get_roots(database, project_folders):
+    ''' Return list of directories indexed in a database. '''
+    roots = [os.path.expandvars(root) for root in database.get('roots', [])]
+    if database.get('include_project_folders'):
+        roots.extend(project_folders)
+    return roots
+
+
 class SymDbClient(LPCClient):
     _databases = None
+    _watched = frozenset()  # (database path, roots) watched by the process.
+    generation = None  # Last known generation of the databases.
+
+    def _startup(self):
+        if self._process is None:
+            self._watched = set()
+            LPCClient._startup(self)
+            if self._stats is not None:
+                self._call('set_profiling', True)
+        else:
+            LPCClient._startup(self)
+
+    def commit(self):
+        self.generation = self._call('commit')
+
+    def update_generation(self):
+        self.generation = self._call('get_generation')
+
+    def set_profiling(self, enabled):
+        ''' Enable or disable profiling both here and in the helper process. '''
+        self._set_profiling(enabled)
+        self._call('set_profiling', enabled)
+
+    def watch_databases(self, databases, project_folders):
+        ''' Start watching databases with "watch" option enabled. Reports
+        problems of watchers started earlier.
+        '''
+        self.set_databases(databases)
+        watched = False
+        for dbi, database in enumerate(databases):
+            if not database.get('watch') or database.get('readonly'):
+                continue
+            key = database['path'], tuple(get_roots(database,
+                                                    project_folders))
+            if key not in self._watched:
+                self.watch(dbi, key[1], database.get('pattern'),
+                           get_exclude(database),
+                           database.get('follow_symlinks', False),
+                           database.get('namespace_packages', False))
+                self._watched.add(key)
+            watched = True
+        if watched:
+            errors = self.get_watch_errors()
+            if errors:
+                ui_worker.schedule(status_message,
+                                   'PyTags: ' + '; '.join(errors))
 
     def set_databases(self, databases):
         if databases != self._databases or self._process is None:
-            PyTagsListener.invalidate_cache()
             self._error = None
             self._databases = databases
-            self._call('set_databases', [os.path.expandvars(db['path'])
-                                         for db in databases])
+            snapshot_keys = {}
+            for dbi, database in enumerate(databases):
+                lockfile = database.get('lockfile')
+                if database.get('readonly'):
+                    snapshot_keys[dbi] = (
+                        database.get('python_version'),
+                        lockfile and os.path.expandvars(lockfile))
+            errors = self._call(
+                'set_databases',
+                [os.path.expandvars(db['path']) for db in databases],
+                list(snapshot_keys), snapshot_keys)
+            if errors:
+                ui_worker.schedule(status_message,
+                                   'PyTags: ' + '; '.join(errors))
 
 
 # Interface to code running in external Python interpreter. It keeps some state
@@ -50,6 +129,10 @@ symdb = SymDbClient(os.path.abspath(os.path.join(
     'external',
     'symdb.py')))
 
+# Start the helper process when the plugin is loaded, rather than on the first
+# query.
+async_worker.schedule(symdb._startup)
+
 
 class PyTagsCommandMixin(object):
     def is_enabled(self, **kwargs):
@@ -69,6 +152,10 @@ class PyTagsCommandMixin(object):
 class PyFindSymbolCommand(PyTagsCommandMixin, TextCommand):
     PROMPT = 'Symbol: '
 
+    # Number of results fetched at once. Results are ranked by relevance, so
+    # the first page usually has the one user is looking for.
+    PAGE_SIZE = 100
+
     def run(self, edit, ask=False):
         # Try to get the symbol from current selection.
         sel = self.view.sel()
@@ -90,49 +177,94 @@ class PyFindSymbolCommand(PyTagsCommandMixin, TextCommand):
                                             None, None)
 
     def search(self, symbol):
-        def async_search(databases):
+        def async_search(databases, file_name, project_folders):
             symdb.set_databases(databases)
-            results = symdb.query_occurrences(symbol)
-            ui_worker.schedule(handle_results, results)
+            results, cursor = symdb.query_occurrences_page(
+                symbol, self.PAGE_SIZE, file_name, project_folders)
+            ui_worker.schedule(handle_results, results, cursor)
 
-        def handle_results(results):
-            if len(results) > 1:
-                self.ask_user_result(results)
+        def handle_results(results, cursor):
+            if len(results) > 1 or cursor is not None:
+                self.ask_user_result(results, cursor)
             elif results:  # len(results) == 1
                 self.goto(results[0])
             else:
                 message_dialog('Symbol "{0}" not found'.format(symbol))
 
+        window = self.view.window()
         async_worker.schedule(async_search,
-                              self.view.settings().get('pytags_databases'))
+                              self.view.settings().get('pytags_databases'),
+                              self.view.file_name(),
+                              window.folders() if window else [],
+                              _priority=PRIORITY_INTERACTIVE)
+
+    def ask_user_result(self, results, cursor):
+        ''' Show results in a quick panel. If there are more results to fetch
+        (cursor is not None), a "more" item is added at the end.
+        '''
+        def async_fetch_more():
+            more, next_cursor = symdb.fetch_occurrences_page(cursor,
+                                                             self.PAGE_SIZE)
+            ui_worker.schedule(self.ask_user_result, results + more,
+                               next_cursor)
 
-    def ask_user_result(self, results):
         def on_select(i):
-            if i != -1:
+            if i == len(results):
+                async_worker.schedule(async_fetch_more,
+                                      _priority=PRIORITY_INTERACTIVE)
+            elif i != -1:
                 self.goto(results[i])
 
-        self.view.window().show_quick_panel(map(self.format_result, results),
-                                            on_select)
+        items = map(self.format_result, results)
+        if cursor is not None:
+            items.append(['More results...', '', ''])
+        self.view.window().show_quick_panel(items, on_select)
 
     def goto(self, result):
-        self.view.window().open_file('{0}:{1}:{2}'.format(result['file'],
-                                                          result['row'] + 1,
-                                                          result['col'] + 1),
+        symbol, path, row, col, scope, package = result
+        self.view.window().open_file('{0}:{1}:{2}'.format(path, row + 1,
+                                                          col + 1),
                                      ENCODED_POSITION)
 
     def format_result(self, result):
-        dir_name, file_name = os.path.split(result['file'])
-        return ['.'.join(filter(None, (result['package'], result['scope'],
-                                       result['symbol']))),
-                u'{0}:{1}'.format(file_name, result['row']),
+        symbol, path, row, col, scope, package = result
+        dir_name, file_name = os.path.split(path)
+        return ['.'.join(filter(None, (package, scope, symbol))),
+                u'{0}:{1}'.format(file_name, row),
                 dir_name]
 
 
 class PyTagsListener(EventListener):
-    NO_PARAMS = None, ' '  # Space is not valid qualified symbol prefix.
+    # Maximum number of cached completion queries.
+    COMPLETION_CACHE_SIZE = 32
+
+    # Cached results are valid as long as database generation does not change.
+    # Commits made by the plugin update the generation right away, commits
+    # made by watchers are noticed by checking it at most that often (in
+    # seconds) while completions are served from the cache.
+    GENERATION_CHECK_INTERVAL = 1
+
+    # (database paths, kind, module, prefix) -> [AsyncResult, last use time].
+    # Results are (generation, completions) pairs.
+    completion_cache = {}
+    cache_clock = count()
+    generation_check_time = 0
+
+    # Milliseconds during which opened and saved files are collected to be
+    # indexed together.
+    INDEX_DELAY = 300
+
+    index_queue = []  # (databases, project folders, file names) tuples.
+    index_scheduled = False
+
+    # Seconds without user activity after which databases of the last active
+    # view are maintained (the helper process does it at most once in a
+    # while, see symdb.maintain).
+    MAINTENANCE_IDLE_TIME = 60
 
-    result = None
-    result_params = NO_PARAMS
+    last_activity = 0
+    maintenance_databases = None
+    maintenance_scheduled = False
 
     def index_view(self, view):
         databases = view.settings().get('pytags_databases')
@@ -145,38 +277,115 @@ class PyTagsListener(EventListener):
             # This sometimes happens, no idea when/why.
             project_folders = []
 
-        async_worker.schedule(self.async_index_view, view.file_name(),
-                              databases, project_folders)
+        self.queue_index(view.file_name(), databases, project_folders)
+
+    @classmethod
+    def queue_index(cls, file_name, databases, project_folders):
+        ''' Add a file to be indexed with other files queued in a short time
+        window (eg. when many files are opened at once), so that they all get
+        indexed in one go and committed once.
+        '''
+        for queued_databases, queued_folders, file_names in cls.index_queue:
+            if queued_databases == databases and \
+                    queued_folders == project_folders:
+                if file_name not in file_names:
+                    file_names.append(file_name)
+                break
+        else:
+            cls.index_queue.append((databases, project_folders, [file_name]))
+
+        if not cls.index_scheduled:
+            cls.index_scheduled = True
+            set_timeout(cls.flush_index_queue, cls.INDEX_DELAY)
+
+    @classmethod
+    def flush_index_queue(cls):
+        for databases, project_folders, file_names in cls.index_queue:
+            async_worker.schedule(cls.async_index_files, file_names,
+                                  databases, project_folders)
+        cls.index_queue = []
+        cls.index_scheduled = False
 
     @staticmethod
-    def async_index_view(file_name, databases, project_folders):
-        norm_file_name = os.path.normcase(file_name)
+    def async_index_files(file_names, databases, project_folders):
         symdb.set_databases(databases)
-        for dbi, database in enumerate(databases):
-            roots = database.get('roots', [])
-            if database.get('include_project_folders'):
-                roots.extend(project_folders)
-            if roots:
-                for root in roots:
-                    root = os.path.normcase(
-                        os.path.normpath(os.path.expandvars(root)))
-                    if norm_file_name.startswith(root + os.sep):
-                        break
-                else:
-                    continue
+        with symdb._batch() as batch:
+            for dbi, database in enumerate(databases):
+                paths = [file_name for file_name in file_names
+                         if PyTagsListener.matches_database(file_name,
+                                                            database,
+                                                            project_folders)]
+                if paths:
+                    batch.process_files(
+                        dbi, paths, get_roots(database, project_folders),
+                        database.get('namespace_packages', False))
+
+            # process_files may skip files due to syntax errors, but still
+            # update their last read times, so commit anyway.
+            batch.commit()
+
+        symdb.generation = batch.results[-1]
+        indexed = set()
+        for paths in batch.results[:-1]:
+            indexed.update(paths)
+        if len(indexed) == 1:
+            ui_worker.schedule(status_message, 'Indexed ' + indexed.pop())
+        elif indexed:
+            ui_worker.schedule(status_message,
+                               'Indexed {0} files'.format(len(indexed)))
 
-            pattern = database.get('pattern')
-            if pattern and not re.search(pattern, file_name):
-                continue
+    @classmethod
+    def schedule_maintenance(cls, databases):
+        cls.last_activity = time()
+        cls.maintenance_databases = databases
+        if not cls.maintenance_scheduled:
+            cls.maintenance_scheduled = True
+            set_timeout(cls.maintain_if_idle, cls.MAINTENANCE_IDLE_TIME * 1000)
 
-            processed = symdb.process_file(dbi, file_name)
+    @classmethod
+    def maintain_if_idle(cls):
+        delay = cls.MAINTENANCE_IDLE_TIME - (time() - cls.last_activity)
+        if PyBuildIndexCommand.index_in_progress:
+            delay = cls.MAINTENANCE_IDLE_TIME
+        if delay > 0:
+            set_timeout(cls.maintain_if_idle, int(delay * 1000) + 1)
+            return
 
-            # process_file may return False due to syntax error, but still
-            # update last read time, so commit anyway.
-            symdb.commit()
+        cls.maintenance_scheduled = False
+        async_worker.schedule(cls.async_maintain, cls.maintenance_databases,
+                              _priority=PRIORITY_BACKGROUND)
+
+    @staticmethod
+    def async_maintain(databases):
+        symdb.set_databases(databases)
+        symdb.maintain()
 
-            if processed:
-                ui_worker.schedule(status_message, 'Indexed ' + file_name)
+    @staticmethod
+    def matches_database(file_name, database, project_folders):
+        ''' Test whether the file should be indexed in given database. '''
+        if database.get('readonly'):
+            return False
+
+        norm_file_name = os.path.normcase(file_name)
+        roots = get_roots(database, project_folders)
+        if roots:
+            for root in roots:
+                root = os.path.normcase(os.path.normpath(root))
+                if norm_file_name.startswith(root + os.sep):
+                    dir_names = norm_file_name[len(root) + 1:]
+                    break
+            else:
+                return False
+        else:
+            dir_names = norm_file_name
+        dir_names = dir_names.split(os.sep)[:-1]
+
+        for glob in get_exclude(database):
+            if fnmatch.filter(dir_names, glob):
+                return False
+
+        pattern = database.get('pattern')
+        return not pattern or re.search(pattern, file_name)
 
     def on_load(self, view):
         file_name = view.file_name()  # This may be None.
@@ -189,6 +398,9 @@ class PyTagsListener(EventListener):
                 view.settings().get('pytags_index_on_save'):
             self.index_view(view)
 
+    def on_modified(self, view):
+        PyTagsListener.last_activity = time()
+
     @staticmethod
     def get_prefix(view, pos):
         ''' Return module path prefix overlapping text at pos. '''
@@ -198,9 +410,34 @@ class PyTagsListener(EventListener):
         return match.group()[::-1]
 
     @classmethod
-    def invalidate_cache(cls):
-        cls.result = None
-        cls.result_params = cls.NO_PARAMS
+    def get_cached_completions(cls, key, prefix):
+        ''' Return AsyncResult of a cached query for key and prefix, or for
+        key and a shorter prefix (results of which can be narrowed down). None
+        if there's no such valid query.
+        '''
+        cache = cls.completion_cache
+        for i in xrange(len(prefix), -1, -1):
+            entry_key = key + (prefix[:i],)
+            entry = cache.get(entry_key)
+            if entry is None:
+                continue
+
+            completed, result = entry[0].get(0)
+            if entry[0].failed or \
+                    completed and result[0] != symdb.generation:
+                del cache[entry_key]
+                continue
+
+            entry[1] = next(cls.cache_clock)
+            return entry[0]
+        return None
+
+    @classmethod
+    def cache_completions(cls, key, result):
+        cache = cls.completion_cache
+        if len(cache) >= cls.COMPLETION_CACHE_SIZE:
+            del cache[min(cache, key=lambda entry_key: cache[entry_key][1])]
+        cache[key] = [result, next(cls.cache_clock)]
 
     @classmethod
     def on_query_completions(cls, view, prefix, locations):
@@ -209,6 +446,7 @@ class PyTagsListener(EventListener):
         # Test if completion disabled by user.
         if not settings.get('pytags_complete_imports'):
             return []
+        cls.last_activity = time()
 
         # Automatically use completion-enabled syntax.
         if settings.get('syntax') == 'Packages/Python/Python.tmLanguage':
@@ -234,7 +472,6 @@ class PyTagsListener(EventListener):
             # from foo.b<ar-to-complete> import..
             # import foo.b<ar-to-complete>
             module_prefix = cls.get_prefix(view, locations[0])
-            dot_count = module_prefix.count('.')
             complete_member = False
         else:
             # Not in import/from..import statement context.
@@ -243,42 +480,46 @@ class PyTagsListener(EventListener):
         # Query the database.
         def async_query_completions(databases):
             symdb.set_databases(databases)
+            with symdb._batch() as batch:
+                if complete_member:
+                    batch.query_members(module_name, prefix)
+                else:
+                    batch.query_package_components(module_prefix)
+                batch.get_generation()
 
-            if complete_member:
-                return symdb.query_members(module_name, prefix)
-            else:
-                return symdb.query_packages(module_prefix)
+            items, symdb.generation = batch.results
+            return symdb.generation, items
 
+        databases = settings.get('pytags_databases')
+        paths = tuple(os.path.expandvars(database['path'])
+                      for database in databases)
         if complete_member:
-            if cls.result_params[0] != module_name or \
-                    not prefix.startswith(cls.result_params[1]):
-                # Previous request is not compatible with current one.
-                cls.result = None
+            key = paths, 'members', module_name
+            query_prefix = prefix
         else:
-            if not module_prefix.startswith(cls.result_params[1]) or \
-                    cls.result_params[0] is not None:
-                # Previous request is not compatible with current one.
-                cls.result = None
-
-        if cls.result is None:
-            cls.result = async_worker.call(async_query_completions,
-                                            settings.get('pytags_databases'))
-            if complete_member:
-                cls.result_params = module_name, prefix
-            else:
-                cls.result_params = None, module_prefix
-
-        completed, items = cls.result.get(1.08)
-        if not completed:
+            # Results are components following the last dot.
+            parent, sep, query_prefix = module_prefix.rpartition('.')
+            key = paths, 'packages', parent + sep
+
+        result = cls.get_cached_completions(key, query_prefix)
+        if result is None:
+            result = async_worker.call(async_query_completions, databases,
+                                       _priority=PRIORITY_INTERACTIVE)
+            cls.cache_completions(key + (query_prefix,), result)
+        elif time() - cls.generation_check_time > \
+                cls.GENERATION_CHECK_INTERVAL:
+            cls.generation_check_time = time()
+            async_worker.schedule(symdb.update_generation,
+                                  _priority=PRIORITY_INTERACTIVE)
+
+        completed, value = result.get(1.08)
+        if not completed or result.failed:
             return []
+        # Cached results may be for a shorter prefix.
+        items = [item for item in value[1] if item.startswith(query_prefix)]
 
         if not complete_member:
-            modules = set()
-            for item in items:
-                item = item.split('.')
-                if dot_count < len(item):
-                    modules.add(item[dot_count])
-            completions = [(module + '\tModule', module) for module in modules]
+            completions = [(item + '\tModule', item) for item in items]
         else:
             completions = [(item + '\tMember', item) for item in items]
 
@@ -288,6 +529,28 @@ class PyTagsListener(EventListener):
         else:
             return completions
 
+    def on_activated(self, view):
+        profiling = bool(view.settings().get('pytags_profiling'))
+        if profiling != PyToggleProfilingCommand.profiling_setting:
+            # Only react to setting changes, so that it can be overridden with
+            # PyToggleProfilingCommand.
+            PyToggleProfilingCommand.profiling_setting = profiling
+            PyToggleProfilingCommand.set_profiling(profiling)
+
+        databases = view.settings().get('pytags_databases')
+        if databases:
+            # Helper process keeps recently used databases open, so it's cheap
+            # if they already are.
+            async_worker.schedule(symdb.set_databases, databases)
+            self.schedule_maintenance(databases)
+        if databases and any(database.get('watch') for database in databases):
+            if view.window():
+                project_folders = view.window().folders()
+            else:
+                project_folders = []
+            async_worker.schedule(symdb.watch_databases, databases,
+                                  project_folders)
+
     def on_query_context(self, view, key, operator, operand, match_all):
         if key != 'pytags_index_in_progress':
             return None
@@ -301,6 +564,11 @@ class PyTagsListener(EventListener):
 
 
 class PyBuildIndexCommand(PyTagsCommandMixin, TextCommand):
+    # Number of files sent to the helper process at once. Files in a batch are
+    # parsed in parallel, but cancel requests are checked and other calls
+    # (like completions) get executed only between batches.
+    BATCH_SIZE = 128
+
     index_in_progress = False
 
     def run(self, edit, action='update'):
@@ -317,9 +585,10 @@ class PyBuildIndexCommand(PyTagsCommandMixin, TextCommand):
                              '"rebuild"}')
 
         self.__class__.index_in_progress = True
-        async_worker.schedule(self.async_process_files,
-                              self.view.settings().get('pytags_databases', []),
-                              self.view.window().folders(), rebuild)
+        async_worker.schedule_task(self.async_process_files,
+                                   self.view.settings().get('pytags_databases',
+                                                            []),
+                                   self.view.window().folders(), rebuild)
 
     def is_enabled(self, action='update'):
         if not PyTagsCommandMixin.is_enabled(self):
@@ -332,59 +601,204 @@ class PyBuildIndexCommand(PyTagsCommandMixin, TextCommand):
     @classmethod
     def async_process_files(cls, databases, project_folders, rebuild):
         try:
-            cls.async_process_files_inner(databases, project_folders, rebuild)
+            for step in cls.async_process_files_inner(databases,
+                                                      project_folders,
+                                                      rebuild):
+                yield
         finally:
             cls.index_in_progress = False
 
+    @staticmethod
+    def process_batch(dbi, paths, roots, namespace_packages, next_paths=(),
+                      rebuild=False):
+        ''' Returns False if the database was to be rebuilt, but is not
+        anymore.
+        '''
+        if paths:
+            indexed = symdb.process_files(dbi, paths, roots,
+                                          namespace_packages, next_paths,
+                                          rebuild)
+            if indexed is None:
+                return False
+            if indexed:
+                ui_worker.schedule(status_message, 'Indexed ' + indexed[-1])
+            # Do not commit after each batch, since it's very slow.
+        return True
+
+    @staticmethod
+    def rebuild_failed(database):
+        # The rebuild was discarded (eg. the helper process was restarted or
+        # the new database was locked), the old database is left as it was.
+        ui_worker.schedule(status_message, 'Rebuilding {0} failed, '
+                           'rebuild the index again'.format(database['path']))
+
     @classmethod
     def async_process_files_inner(cls, databases, project_folders, rebuild):
-        if rebuild:
-            # Helper process should not reference files to be deleted.
-            symdb._cleanup()
-
-            # Simply remove associated database files if build from scratch is
-            # requested.
-            for database in databases:
-                try:
-                    os.remove(os.path.expandvars(database['path']))
-                except OSError:
-                    # Specified database file may not yet exist or is
-                    # inaccessible.
-                    pass
-
-        symdb.set_databases(databases)
+        # This is executed as a background task, yielding to other calls after
+        # each step. These may switch the databases, so set them again each
+        # time (the helper process commits pending changes when switching).
         for dbi, database in enumerate(databases):
-            roots = database.get('roots', [])
-            for i, root in enumerate(roots):
-                roots[i] = os.path.expandvars(root)
-            if database.get('include_project_folders'):
-                roots.extend(project_folders)
-
-            symdb.begin_file_processing(dbi)
-
-            for symbol_root in roots:
-                for root, dirs, files in os.walk(symbol_root):
-                    for file_name in files:
-                        if not cls.index_in_progress:
-                            symdb.end_file_processing(dbi)
-                            symdb.commit()
-                            ui_worker.schedule(status_message,
-                                               'Indexing canceled')
-                            return
-                        if not is_python_source_file(file_name):
-                            continue
-
-                        path = os.path.abspath(os.path.join(root,
-                                                            file_name))
-                        pattern = database.get('pattern')
-                        if not pattern or re.search(pattern, path):
-                            if symdb.process_file(dbi, path):
-                                ui_worker.schedule(status_message,
-                                                   'Indexed ' + path)
-                                # Do not commit after each file, since it's
-                                # very slow.
-
-            symdb.end_file_processing(dbi)
-            symdb.commit()
+            if database.get('readonly'):
+                # Snapshots are built elsewhere (see export_snapshot).
+                continue
+            roots = get_roots(database, project_folders)
+
+            symdb.set_databases(databases)
+            if rebuild:
+                # Build a new database next to the old one, which is still
+                # used by queries until it is replaced.
+                symdb.begin_rebuild(dbi)
+
+            # Only new and modified files are returned, files that are gone
+            # are removed right away.
+            namespace_packages = database.get('namespace_packages', False)
+            changed = symdb.scan_roots(dbi, roots, database.get('pattern'),
+                                       get_exclude(database),
+                                       database.get('follow_symlinks', False),
+                                       namespace_packages)
+            yield
+
+            for i in xrange(0, len(changed), cls.BATCH_SIZE):
+                symdb.set_databases(databases)
+                if not cls.index_in_progress:
+                    if rebuild:
+                        symdb.abort_rebuild(dbi)
+                    else:
+                        symdb.commit()
+                    ui_worker.schedule(status_message, 'Indexing canceled')
+                    return
+                # The next batch gets parsed while this one is written.
+                if not cls.process_batch(dbi, changed[i:i + cls.BATCH_SIZE],
+                                         roots, namespace_packages,
+                                         changed[i + cls.BATCH_SIZE:
+                                                 i + 2 * cls.BATCH_SIZE],
+                                         rebuild):
+                    cls.rebuild_failed(database)
+                    return
+                yield
+
+            symdb.set_databases(databases)
+            if rebuild:
+                generation = symdb.finish_rebuild(dbi)
+                if generation is None:
+                    cls.rebuild_failed(database)
+                    return
+                symdb.generation = generation
+            else:
+                symdb.commit()
 
         ui_worker.schedule(status_message, 'Done indexing')
+
+
+class PyToggleProfilingCommand(WindowCommand):
+    profiling = False
+    profiling_setting = False  # Last seen value of pytags_profiling.
+
+    @classmethod
+    def set_profiling(cls, enabled):
+        cls.profiling = enabled
+        async_worker.schedule(symdb.set_profiling, enabled)
+
+    def run(self):
+        self.set_profiling(not self.profiling)
+        status_message('PyTags profiling ' +
+                       ('enabled' if self.profiling else 'disabled'))
+
+    def description(self):
+        return ('Disable' if self.profiling else 'Enable') + ' Profiling'
+
+
+class PyPerformanceReportCommand(WindowCommand):
+    # Number of slowest queries and files shown.
+    LIMIT = 30
+
+    def run(self):
+        def async_report(databases):
+            report = symdb.profiling_report(self.LIMIT)
+            storage = None
+            if databases:
+                symdb.set_databases(databases)
+                storage = symdb.storage_stats()
+            ui_worker.schedule(self.show_report, symdb._profiling_report(),
+                               report, storage)
+
+        view = self.window.active_view()
+        async_worker.schedule(async_report,
+                              view and view.settings().get('pytags_databases'),
+                              _priority=PRIORITY_INTERACTIVE)
+
+    def show_report(self, lpc_stats, report, storage):
+        view = self.window.new_file()
+        view.set_name('PyTags Performance Report')
+        view.set_scratch(True)
+        edit = view.begin_edit()
+        view.insert(edit, 0, self.format_report(lpc_stats, report) +
+                    self.format_storage(storage))
+        view.end_edit(edit)
+
+    def format_storage(self, storage):
+        if not storage:
+            return ''
+
+        lines = ['', 'Storage', '=======', '',
+                 '{0:>8} {1:>8} {2:>6} {3:>8} {4:>10} {5:>8}  {6}'.format(
+                     'size MB', 'WAL MB', 'free %', 'files', 'symbols',
+                     'analyzed', 'path')]
+        for stats in storage:
+            lines.append(u'{0:8.1f} {1:8.1f} {2:6.1f} {3:8} {4:10} {5:>8}  '
+                         u'{6}'.format(
+                             stats['page_count'] * stats['page_size'] /
+                             1024 ** 2,
+                             stats['wal_size'] / 1024 ** 2,
+                             stats['freelist_count'] * 100 /
+                             max(stats['page_count'], 1),
+                             stats['files'], stats['symbols'],
+                             'yes' if stats['analyzed'] else 'no',
+                             stats['path']))
+        return '\n'.join(lines) + '\n'
+
+    def format_report(self, lpc_stats, report):
+        if lpc_stats is None or report is None:
+            return 'Profiling is disabled. Enable it with "PyTags: Toggle ' \
+                'Profiling" or the "pytags_profiling" setting.\n'
+
+        lines = ['LPC calls', '=========', '',
+                 '{0:>8} {1:>10} {2:>8} {3:>8} {4:>10} {5:>10}  {6}'.format(
+                     'calls', 'total ms', 'avg ms', 'max ms', 'sent KB',
+                     'recv KB', 'name')]
+        for name, stats in lpc_stats:
+            lines.append(
+                '{0:8} {1:10.1f} {2:8.2f} {3:8.1f} {4:10.1f} {5:10.1f}  '
+                '{6}'.format(stats.count, stats.total_time * 1000,
+                             stats.total_time * 1000 / stats.count,
+                             stats.max_time * 1000, stats.sent / 1024,
+                             stats.received / 1024, name))
+            lines.append('{0:>8} {1}'.format('', ' '.join(
+                '{0}:{1}'.format(label, n)
+                for label, n in zip(self.bucket_labels(), stats.histogram)
+                if n)))
+
+        lines.extend(['', 'Slowest queries', '===============', ''])
+        for total, calls, max_time, query, plan in report['queries']:
+            lines.append('{0:.1f} ms total, {1} calls, {2:.1f} ms max'.format(
+                total * 1000, calls, max_time * 1000))
+            lines.append('    ' + ' '.join(query.split()))
+            lines.extend('    > ' + line
+                         for line in (plan or '').splitlines())
+            lines.append('')
+
+        lines.extend(['Slowest files', '=============', '',
+                      '{0:>10} {1:>10} {2:>10} {3:>8}  {4}'.format(
+                          'total ms', 'parse ms', 'insert ms', 'symbols',
+                          'path')])
+        for total, parse, insert, symbol_count, path in report['files']:
+            lines.append(u'{0:10.1f} {1:10.1f} {2:10.1f} {3:8}  {4}'.format(
+                total * 1000, parse * 1000, insert * 1000, symbol_count, path))
+
+        return '\n'.join(lines) + '\n'
+
+    @staticmethod
+    def bucket_labels():
+        labels = ['<{0:g}ms'.format(bound * 1000) for bound in LATENCY_BUCKETS]
+        labels.append('>{0:g}ms'.format(LATENCY_BUCKETS[-1] * 1000))
+        return labels
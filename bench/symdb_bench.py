@@ -0,0 +1,308 @@
+''' Headless benchmark of the external symbol database, runnable without
+Sublime Text. Generates a synthetic corpus, indexes it with external/symdb.py
+(directly or through LPCClient, the way the plugin does) and reports indexing
+throughput and query latencies. Run with the interpreter used for the external
+process, eg.:
+
+    python bench/symdb_bench.py --files 2000 --databases 3 --via both
+'''
+
+import argparse
+import os
+import os.path
+import random
+import shutil
+import sys
+import tempfile
+
+from time import time
+
+PACKAGE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+SYMDB_PATH = os.path.join(PACKAGE_DIR, 'external', 'symdb.py')
+
+sys.path.insert(0, PACKAGE_DIR)
+sys.path.insert(0, os.path.dirname(SYMDB_PATH))
+
+from pytags.lpc.client import LPCClient
+
+# Number of files sent to process_files at once (same as the plugin does).
+BATCH_SIZE = 128
+
+
+class DirectClient(object):
+    ''' Calls symdb functions in this process, provides the same interface as
+    LPCClient.
+    '''
+
+    def __init__(self):
+        import symdb
+        self._module = symdb
+
+    def _cleanup(self):
+        pass
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return getattr(self._module, name)
+
+
+def make_client(via, python, wire):
+    if via == 'direct':
+        return DirectClient()
+    else:
+        return LPCClient(SYMDB_PATH, python, compact=wire == 'compact')
+
+
+def generate_module(args, seed):
+    rnd = random.Random(seed)
+    lines = ['import os', '']
+    for i in xrange(args.symbols):
+        lines.append('CONSTANT_{0} = {1}'.format(i, rnd.randint(0, 1000)))
+    for i in xrange(args.classes):
+        lines.extend(['', '', 'class Class{0}(object):'.format(i)])
+        for j in xrange(args.symbols):
+            lines.append('    attr_{0} = {0}'.format(j))
+        for j in xrange(args.symbols):
+            lines.extend(['', '    def method_{0}(self, x):'.format(j),
+                          '        return self.attr_{0} + x'.format(j)])
+        lines.extend(['', '    def get(self):', '        return None'])
+    for i in xrange(args.symbols):
+        lines.extend(['', '', 'def function_{0}(a, b):'.format(i),
+                      '    return a + b'])
+    return '\n'.join(lines) + '\n'
+
+
+def generate_corpus(args, directory, dbi):
+    ''' Generate a tree of packages args.depth levels deep, with args.files
+    modules spread among leaf packages. Returns list of generated module
+    names.
+    '''
+    modules = []
+    for i in xrange(args.files):
+        names = ['db{0}pkg{1}'.format(dbi, i % args.fanout)]
+        for level in xrange(1, args.depth):
+            names.append('sub{0}'.format((i // args.fanout ** level) %
+                                         args.fanout))
+        for level in xrange(len(names)):
+            package_dir = os.path.join(directory, *names[:level + 1])
+            if not os.path.isdir(package_dir):
+                os.makedirs(package_dir)
+                open(os.path.join(package_dir, '__init__.py'), 'w').close()
+        names.append('mod{0}'.format(i))
+        modules.append('.'.join(names))
+        with open(os.path.join(directory, *names) + '.py', 'w') as f:
+            f.write(generate_module(args, i))
+    return sorted(modules)
+
+
+def index(client, dbi, root):
+    ''' Update index the way PyBuildIndexCommand does. Returns number of
+    indexed files.
+    '''
+    changed = client.scan_roots(dbi, [root])
+    indexed = 0
+    for i in xrange(0, len(changed), BATCH_SIZE):
+        indexed += len(client.process_files(
+            dbi, changed[i:i + BATCH_SIZE],
+            next_paths=changed[i + BATCH_SIZE:i + 2 * BATCH_SIZE]))
+    client.commit()
+    return indexed
+
+
+def percentile(times, fraction):
+    times = sorted(times)
+    return times[min(len(times) - 1, int(len(times) * fraction))]
+
+
+def report(name, times):
+    print '  {0:<40} p50 {1:8.2f} ms   p99 {2:8.2f} ms'.format(
+        name, percentile(times, 0.5) * 1000, percentile(times, 0.99) * 1000)
+
+
+def measure(f, *args):
+    begin = time()
+    f(*args)
+    return time() - begin
+
+
+def compare_extractors(args, directories):
+    ''' Compare SymbolScanner with AST-based SymbolExtractor on files under
+    given directories and a large generated module. Reports time taken by
+    each and files for which their results differ.
+    '''
+    import ast
+    import symdb
+
+    print 'extractors:'
+    large_module = os.path.join(directories[0], 'large_module.py')
+    with open(large_module, 'w') as f:
+        f.write(generate_module(argparse.Namespace(
+            classes=args.classes * 100, symbols=args.symbols), 0))
+
+    # Small or large (at least SCAN_MIN_SIZE) -> [files, AST time, scanner
+    # time].
+    totals = {False: [0, 0, 0], True: [0, 0, 0]}
+    for directory in directories:
+        for dir_path, dir_names, file_names in os.walk(directory):
+            for file_name in file_names:
+                if not file_name.endswith('.py'):
+                    continue
+                path = os.path.join(dir_path, file_name)
+                with open(path) as f:
+                    source = f.read()
+
+                begin = time()
+                try:
+                    extractor = symdb.SymbolExtractor()
+                    extractor.visit(ast.parse(source, path))
+                except SyntaxError:
+                    continue
+                ast_time = time() - begin
+
+                begin = time()
+                scanner = symdb.SymbolScanner(source)
+                try:
+                    scanner.scan()
+                except SyntaxError:
+                    # Falls back to AST, not a mismatch.
+                    continue
+                scan_time = time() - begin
+
+                if scanner.symbols != extractor.symbols:
+                    print '  results differ: ' + path
+                total = totals[len(source) >= symdb.SCAN_MIN_SIZE]
+                total[0] += 1
+                total[1] += ast_time
+                total[2] += scan_time
+
+    for large in (False, True):
+        count, ast_time, scan_time = totals[large]
+        if count:
+            print '  {0:<6} files: {1:6}   AST {2:8.1f} ms   scanner {3:8.1f} ' \
+                'ms'.format('large' if large else 'small', count,
+                            ast_time * 1000, scan_time * 1000)
+
+
+def run(args, via, work_dir, roots, modules):
+    print '{0}:'.format(via if via == 'direct' else
+                        '{0} ({1} replies)'.format(via, args.wire))
+    client = make_client(via, args.python, args.wire)
+    db_paths = [os.path.join(work_dir, '{0}-{1}.db'.format(via, dbi))
+                for dbi in xrange(args.databases)]
+    rnd = random.Random(0)
+
+    try:
+        # Full rebuild of every database.
+        for path in db_paths:
+            if os.path.exists(path):
+                os.remove(path)
+        client.set_databases(db_paths)
+        for dbi, root in enumerate(roots):
+            begin = time()
+            indexed = index(client, dbi, root)
+            elapsed = time() - begin
+            print '  rebuild db{0}: {1} files in {2:.2f} s ({3:.0f} ' \
+                'files/s)'.format(dbi, indexed, elapsed, indexed / elapsed)
+
+        # Update with nothing changed.
+        times = [measure(index, client, 0, roots[0])
+                 for i in xrange(args.repeat)]
+        report('no-op update db0', times)
+
+        # Single modified file.
+        times = []
+        for i in xrange(args.repeat):
+            path = os.path.join(roots[0], *modules[0][0].split('.')) + '.py'
+            with open(path, 'a') as f:
+                f.write('\ndef added_{0}():\n    pass\n'.format(i))
+            # Make sure modification time changes on coarse file systems.
+            mtime = os.path.getmtime(path) + i + 1
+            os.utime(path, (mtime, mtime))
+            times.append(measure(client.process_file, 0, path) +
+                         measure(client.commit))
+        report('single file update', times)
+
+        # Queries with growing number of attached databases.
+        for count in xrange(1, args.databases + 1):
+            print ' {0} database(s):'.format(count)
+            client.set_databases(db_paths[:count])
+            queries = [
+                ('query_occurrences(get)',
+                 client.query_occurrences, ('get',)),
+                ('query_occurrences(Class0.method_0)',
+                 client.query_occurrences, ('Class0.method_0',)),
+                ('query_occurrences_page(get)',
+                 client.query_occurrences_page, ('get', 100)),
+                ('query_members',
+                 lambda: client.query_members(rnd.choice(modules[0]), ''),
+                 ()),
+                ('query_packages',
+                 client.query_packages, ('db0pkg',)),
+                ('query_package_components',
+                 client.query_package_components, ('db0pkg0.',)),
+            ]
+            for name, f, f_args in queries:
+                report(name, [measure(f, *f_args)
+                              for i in xrange(args.queries)])
+    finally:
+        client._cleanup()
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.split('\n\n')[0])
+    parser.add_argument('--files', type=int, default=1000,
+                        help='number of modules per database')
+    parser.add_argument('--classes', type=int, default=5,
+                        help='number of classes per module')
+    parser.add_argument('--symbols', type=int, default=10,
+                        help='number of methods, attributes, functions and '
+                        'constants per class/module')
+    parser.add_argument('--depth', type=int, default=3,
+                        help='package nesting depth')
+    parser.add_argument('--fanout', type=int, default=4,
+                        help='number of subpackages per package')
+    parser.add_argument('--databases', type=int, default=1,
+                        help='number of databases (each with its own corpus)')
+    parser.add_argument('--repeat', type=int, default=5,
+                        help='number of update measurements')
+    parser.add_argument('--queries', type=int, default=50,
+                        help='number of measurements per query')
+    parser.add_argument('--via', choices=['direct', 'lpc', 'both'],
+                        default='lpc', help='how to call symdb')
+    parser.add_argument('--wire', choices=['compact', 'pickle'],
+                        default='compact', help='format of LPC replies')
+    parser.add_argument('--python', default=sys.executable,
+                        help='interpreter for the LPC server')
+    parser.add_argument('--extractors', nargs='*', metavar='DIR',
+                        help='compare symbol extractors on the corpus and '
+                        'given directories (eg. the standard library)')
+    parser.add_argument('--work-dir',
+                        help='directory for corpus and databases (kept), '
+                        'temporary by default')
+    args = parser.parse_args()
+
+    work_dir = args.work_dir or tempfile.mkdtemp(prefix='pytags-bench-')
+    try:
+        roots = []
+        modules = []
+        for dbi in xrange(args.databases):
+            root = os.path.join(work_dir, 'corpus{0}'.format(dbi))
+            if os.path.isdir(root):
+                shutil.rmtree(root)
+            os.makedirs(root)
+            modules.append(generate_corpus(args, root, dbi))
+            roots.append(root)
+
+        for via in (['direct', 'lpc'] if args.via == 'both' else [args.via]):
+            run(args, via, work_dir, roots, modules)
+
+        if args.extractors is not None:
+            compare_extractors(args, roots + args.extractors)
+    finally:
+        if not args.work_dir:
+            shutil.rmtree(work_dir)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,79 @@
+''' Minimal ctypes binding of Linux inotify API. Importing this module fails
+with ImportError on systems that do not provide inotify.
+'''
+
+import ctypes
+import ctypes.util
+import os
+import struct
+
+from select import select
+
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c') or 'libc.so.6',
+                        use_errno=True)
+    _inotify_init1 = _libc.inotify_init1
+    _inotify_add_watch = _libc.inotify_add_watch
+except (OSError, AttributeError):
+    raise ImportError('inotify is not available')
+
+_inotify_add_watch.argtypes = [ctypes.c_int, ctypes.c_char_p, ctypes.c_uint32]
+
+# Event masks, see inotify(7).
+IN_MODIFY = 0x00000002
+IN_CLOSE_WRITE = 0x00000008
+IN_MOVED_FROM = 0x00000040
+IN_MOVED_TO = 0x00000080
+IN_CREATE = 0x00000100
+IN_DELETE = 0x00000200
+IN_DELETE_SELF = 0x00000400
+IN_MOVE_SELF = 0x00000800
+IN_Q_OVERFLOW = 0x00004000
+IN_IGNORED = 0x00008000
+IN_ONLYDIR = 0x01000000
+IN_ISDIR = 0x40000000
+
+IN_CLOEXEC = 0o2000000
+
+_EVENT_HEADER = struct.Struct('iIII')
+
+
+class Inotify(object):
+    def __init__(self):
+        self.fd = _inotify_init1(IN_CLOEXEC)
+        if self.fd < 0:
+            self._raise()
+
+    def _raise(self):
+        errno = ctypes.get_errno()
+        raise OSError(errno, os.strerror(errno))
+
+    def add_watch(self, path, mask):
+        ''' Start watching path, returns watch descriptor. '''
+        if isinstance(path, unicode):
+            path = path.encode('utf-8')
+        wd = _inotify_add_watch(self.fd, path, mask)
+        if wd < 0:
+            self._raise()
+        return wd
+
+    def read(self, timeout=None):
+        ''' Wait at most timeout seconds for events, returns list of (watch
+        descriptor, mask, name) tuples, possibly empty.
+        '''
+        if not select([self.fd], [], [], timeout)[0]:
+            return []
+
+        data = os.read(self.fd, 65536)
+        events = []
+        pos = 0
+        while pos < len(data):
+            wd, mask, cookie, length = _EVENT_HEADER.unpack_from(data, pos)
+            pos += _EVENT_HEADER.size
+            name = data[pos:pos + length].rstrip('\0')
+            pos += length
+            events.append((wd, mask, name))
+        return events
+
+    def close(self):
+        os.close(self.fd)
@@ -1,65 +1,320 @@
 import ast
+import atexit
+import errno
+import fnmatch
 import os
 import os.path
+import re
+import shutil
 import sqlite3
+import sys
 
-PERF_DATA_DB = None
+from bisect import bisect_left
+from contextlib import contextmanager
+from hashlib import sha1
+from heapq import merge
+from itertools import count, groupby, izip
+from Queue import Queue
+from stat import S_ISDIR
+from threading import Lock, Thread
+from time import time
+from urllib import pathname2url
 
-if PERF_DATA_DB:
-    from time import time
+try:
+    from multiprocessing import Pool
+except ImportError:
+    Pool = None
 
+try:
+    # Faster directory listing, included in Python 3.5 as os.scandir.
+    from scandir import scandir
+except ImportError:
+    scandir = getattr(os, 'scandir', None)
 
-def get_package(path):
-    assert path.endswith('.py')
-    path = path[:-3]
-    path, module = os.path.split(path)
-    if module == '__init__':
-        package = []
-    else:
-        package = [module]
-    while True:
-        new_path, module = os.path.split(path)
-        if not os.path.isfile(os.path.join(path, '__init__.py')):
-            break
-        package.append(module)
-        if new_path == path:
-            break
-        path = new_path
-    return '.'.join(reversed(package))
+try:
+    from inotify import IN_CLOSE_WRITE, IN_CREATE, IN_DELETE, IN_IGNORED, \
+        IN_ISDIR, IN_MOVED_FROM, IN_MOVED_TO, IN_ONLYDIR, IN_Q_OVERFLOW, \
+        Inotify
+except ImportError:
+    Inotify = None
+
+
+def is_python_source_file(file_name):
+    return file_name.endswith('.py') or file_name.endswith('.pyw')
+
+
+class PackageResolver(object):
+    ''' Computes package names of modules, caching package of each
+    directory. Directories walked by find_changed_files are added as they're
+    found, so that computing their packages takes no stat calls. If namespace
+    packages are enabled, directories below roots are packages even if they
+    have no __init__.py (PEP 420). Paths must be normalized (see
+    normalize_path).
+    '''
+
+    def __init__(self, roots=(), namespace_packages=False):
+        self.roots = set(normalize_path(root) for root in roots)
+        self.namespace_packages = namespace_packages
+        self.packages = {}  # Directory -> package.
+
+    def add_directory(self, directory, has_init):
+        ''' Add a walked directory. Directories must be added after their
+        parents.
+        '''
+        parent = os.path.dirname(directory)
+        if directory in self.roots or parent not in self.packages:
+            self.get_directory_package(directory)
+        else:
+            self.packages[directory] = self.child_package(
+                self.packages[parent], directory, has_init,
+                self.namespace_packages)
+
+    def get_directory_package(self, directory):
+        ''' Return package of modules in a directory. '''
+        package = self.packages.get(directory)
+        if package is None:
+            parent = os.path.dirname(directory)
+            has_init = os.path.isfile(os.path.join(directory, '__init__.py'))
+            namespace = self.namespace_packages and \
+                directory not in self.roots and self.is_below_root(directory)
+            if parent != directory and (has_init or namespace):
+                package = self.child_package(
+                    self.get_directory_package(parent), directory, has_init,
+                    namespace)
+            else:
+                package = ''
+            self.packages[directory] = package
+        return package
+
+    def get_package(self, path):
+        ''' Return package name of a module, eg. "os.path" for
+        ".../os/path.py".
+        '''
+        directory, file_name = os.path.split(path)
+        package = self.get_directory_package(directory)
+        module = os.path.splitext(file_name)[0]
+        if module == '__init__':
+            return package
+        return '.'.join(filter(None, (package, module)))
+
+    @staticmethod
+    def child_package(parent_package, directory, has_init, namespace):
+        name = os.path.basename(directory)
+        if has_init or namespace and IDENTIFIER_REGEX.match(name):
+            return '.'.join(filter(None, (parent_package, name)))
+        else:
+            # Modules in this directory are top-level ones.
+            return ''
+
+    def is_below_root(self, directory):
+        return any(directory.startswith(root + os.sep) for root in self.roots)
+
+
+IDENTIFIER_REGEX = re.compile(r'[A-Za-z_][A-Za-z0-9_]*\Z')
+
+
+def normalize_path(path):
+    return os.path.normcase(os.path.normpath(os.path.abspath(path)))
+
+
+def reversed_name(*parts):
+    ''' Join parts of a qualified name and return it with components in
+    reverse order and a trailing dot, eg. "c.b.a." for ("a.b", "c"). Qualified
+    symbol lookups are prefix searches on reversed names, so they can use an
+    index.
+    '''
+    names = '.'.join(filter(None, parts)).split('.')
+    names.reverse()
+    return '.'.join(names) + '.'
+
+
+# Scripts upgrading database schema, N-th script upgrades from version N to
+# N + 1 (version is kept in user_version pragma). New databases are created
+# with the latest schema (see create_schema). "{0}" is replaced with database
+# index.
+SCHEMA_MIGRATIONS = [
+    # Size and content hash, to tell touched files from modified ones.
+    '''
+        ALTER TABLE db{0}.files ADD COLUMN size INTEGER;
+        ALTER TABLE db{0}.files ADD COLUMN hash TEXT;
+    ''',
+    # Symbols removed together with their files.
+    '''
+        CREATE INDEX db{0}.symbols_file_id ON symbols(file_id);
+        CREATE TRIGGER db{0}.files_delete AFTER DELETE ON files
+        BEGIN
+            DELETE FROM symbols WHERE file_id = OLD.id;
+        END;
+    ''',
+    # Strings interned in separate tables, symbols refer to them by ids.
+    # Namespaces (package and scope) are stored in reversed form, to find
+    # symbols qualified with partial namespaces.
+    '''
+        CREATE TABLE db{0}.packages (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        INSERT INTO db{0}.packages(name)
+        SELECT DISTINCT package FROM db{0}.files;
+
+        CREATE TABLE db{0}.names (
+            id INTEGER PRIMARY KEY,
+            name TEXT NOT NULL UNIQUE
+        );
+        INSERT INTO db{0}.names(name)
+        SELECT DISTINCT symbol FROM db{0}.symbols;
+
+        CREATE TABLE db{0}.scopes (
+            id INTEGER PRIMARY KEY,
+            package_id INTEGER NOT NULL REFERENCES packages(id),
+            scope TEXT NOT NULL,
+            rev_namespace TEXT NOT NULL,  -- reversed_name(package, scope).
+            UNIQUE (package_id, scope)
+        );
+        INSERT INTO db{0}.scopes(package_id, scope, rev_namespace)
+        SELECT DISTINCT p.id, s.scope, reversed_name(p.name, s.scope, '')
+        FROM db{0}.symbols s, db{0}.files f, db{0}.packages p
+        WHERE f.id = s.file_id AND p.name = f.package;
+        CREATE INDEX db{0}.scopes_rev_namespace ON scopes(rev_namespace);
+
+        CREATE TABLE db{0}.new_files (
+            id INTEGER PRIMARY KEY,
+            path TEXT NOT NULL UNIQUE,
+            package_id INTEGER NOT NULL REFERENCES packages(id),
+            timestamp REAL NOT NULL,
+            size INTEGER,
+            hash TEXT
+        );
+        INSERT INTO db{0}.new_files(id, path, package_id, timestamp, size,
+                                    hash)
+        SELECT f.id, f.path, p.id, f.timestamp, f.size, f.hash
+        FROM db{0}.files f, db{0}.packages p
+        WHERE p.name = f.package;
+
+        CREATE TABLE db{0}.new_symbols (
+            file_id INTEGER NOT NULL REFERENCES files(id),
+            name_id INTEGER NOT NULL REFERENCES names(id),
+            scope_id INTEGER NOT NULL REFERENCES scopes(id),
+            row INTEGER NOT NULL,
+            col INTEGER NOT NULL
+        );
+        INSERT INTO db{0}.new_symbols(file_id, name_id, scope_id, row, col)
+        SELECT s.file_id, n.id, c.id, s.row, s.col
+        FROM db{0}.symbols s, db{0}.files f, db{0}.packages p, db{0}.names n,
+            db{0}.scopes c
+        WHERE
+            f.id = s.file_id AND
+            p.name = f.package AND
+            n.name = s.symbol AND
+            c.package_id = p.id AND
+            c.scope = s.scope;
+
+        DROP TABLE db{0}.symbols;
+        DROP TABLE db{0}.files;
+        ALTER TABLE db{0}.new_files RENAME TO files;
+        ALTER TABLE db{0}.new_symbols RENAME TO symbols;
+
+        CREATE INDEX db{0}.files_package ON files(package_id);
+        CREATE INDEX db{0}.symbols_name ON symbols(name_id);
+        CREATE INDEX db{0}.symbols_scope_name ON symbols(scope_id, name_id);
+        CREATE INDEX db{0}.symbols_file_id ON symbols(file_id);
+        CREATE TRIGGER db{0}.files_delete AFTER DELETE ON files
+        BEGIN
+            DELETE FROM symbols WHERE file_id = OLD.id;
+        END;
+    ''',
+    # Free pages can be released by maintain (takes effect with VACUUM done
+    # after migrations).
+    '''
+        PRAGMA db{0}.auto_vacuum = INCREMENTAL;
+    ''',
+]
+
+
+class Profiler(object):
+    ''' Collects query and file indexing timings while profiling is enabled
+    (see set_profiling). Shared with watcher threads.
+    '''
+
+    def __init__(self):
+        self.lock = Lock()
+        self.queries = {}  # Query -> [count, total time, max time, plan].
+        self.files = {}    # Path -> (parse time, insert time, symbol count).
+
+    def add_query(self, query, tm, plan):
+        with self.lock:
+            stats = self.queries.get(query)
+            if stats is None:
+                self.queries[query] = [1, tm, tm, plan]
+            else:
+                stats[0] += 1
+                stats[1] += tm
+                stats[2] = max(stats[2], tm)
+
+    def has_plan(self, query):
+        return query in self.queries
+
+    def add_file(self, path, parse_time, insert_time, symbol_count):
+        with self.lock:
+            self.files[path] = parse_time, insert_time, symbol_count
+
+    def report(self, limit):
+        ''' Return slowest queries as (total time, count, max time, query,
+        plan) tuples and slowest files as (total time, parse time, insert time,
+        symbol count, path) tuples, at most limit of each.
+        '''
+        with self.lock:
+            queries = sorted(((total, count, max_time, query, plan)
+                              for query, (count, total, max_time, plan)
+                              in self.queries.iteritems()), reverse=True)
+            files = sorted(((parse + insert, parse, insert, symbol_count, path)
+                            for path, (parse, insert, symbol_count)
+                            in self.files.iteritems()), reverse=True)
+        return {'queries': queries[:limit], 'files': files[:limit]}
+
+
+profiler = None  # Profiler, if profiling is enabled.
 
 
 class InstrumentedCursor(object):
-    ''' A limited SQLite3 cursor implementation that records some query
-    execution data into another table.
+    ''' A limited SQLite3 cursor implementation that records query execution
+    times and plans into a Profiler.
     '''
 
-    def __init__(self, db):
-        self.perfdata_cur = db.cursor()
-        self.perfdata_cur.executescript('''
-            CREATE TABLE IF NOT EXISTS perfdata (
-                query TEXT NOT NULL,
-                plan TEXT NOT NULL,
-                time REAL NOT NULL
-            );
-        ''')
+    def __init__(self, db, profiler):
+        self.db = db
+        self.profiler = profiler
         self.cur = db.cursor()
 
-    def execute(self, query, params=None):
+    def explain(self, query, params):
+        if self.profiler.has_plan(query):
+            return None
+        try:
+            return '\n'.join(row[3] for row in self.db.execute(
+                'EXPLAIN QUERY PLAN ' + query, params))
+        except sqlite3.Error:
+            return ''
+
+    def execute(self, query, params=()):
         query = query.strip()
-        if params is None:
-            params = ()
-        else:
-            params = params,
+        plan = self.explain(query, params)
+        tm = time()
+        self.cur.execute(query, params)
+        self.profiler.add_query(query, time() - tm, plan)
+        return self
 
-        self.perfdata_cur.execute('EXPLAIN QUERY PLAN ' + query, *params)
-        plan = '\n'.join(row[3] for row in self.perfdata_cur)
+    def executemany(self, query, seq_of_params):
+        query = query.strip()
         tm = time()
-        self.cur.execute(query, *params)
-        tm = time() - tm
-        self.perfdata_cur.execute('''
-            INSERT INTO perfdata(query, plan, time)
-            VALUES(:query, :plan, :tm)
-        ''', locals())
+        self.cur.executemany(query, seq_of_params)
+        self.profiler.add_query(query, time() - tm, '')
+        return self
+
+    def executescript(self, script):
+        tm = time()
+        self.cur.executescript(script)
+        self.profiler.add_query(script.strip(), time() - tm, '')
+        return self
 
     def __getattr__(self, name):
         return getattr(self.cur, name)
@@ -68,183 +323,611 @@ class InstrumentedCursor(object):
         return self.cur
 
 
+class PackageTrie(object):
+    ''' Package names arranged in a tree of dotted name components. '''
+
+    class Node(object):
+        __slots__ = 'children', 'names'
+
+        def __init__(self):
+            self.children = {}
+            self.names = None  # Sorted children names.
+
+    def __init__(self, packages):
+        self.root = self.Node()
+        for package in packages:
+            node = self.root
+            for name in package.split('.'):
+                try:
+                    node = node.children[name]
+                except KeyError:
+                    node.children[name] = node = self.Node()
+
+        # Precompute sorted children names.
+        nodes = [self.root]
+        while nodes:
+            node = nodes.pop()
+            node.names = sorted(node.children)
+            nodes.extend(node.children.itervalues())
+
+    def components(self, prefix):
+        ''' Return sorted list of names that can follow given package name
+        prefix, eg. ["bar", "baz"] for "foo.b" if there are "foo.bar" and
+        "foo.baz.qux" packages.
+        '''
+        parent, sep, partial = prefix.rpartition('.')
+        node = self.root
+        if sep:
+            for name in parent.split('.'):
+                try:
+                    node = node.children[name]
+                except KeyError:
+                    return []
+        names = node.names
+        return names[bisect_left(names, partial):
+                     bisect_left(names, partial + u'\uffff')]
+
+
+# Whether ATTACH accepts URI file names (needed to open snapshots read-only).
+# Otherwise the URI would be taken for a plain file name.
+URI_FILE_NAMES = 'USE_URI' in [row[0].split('=')[0] for row in
+                               sqlite3.connect(':memory:').execute(
+                                   'PRAGMA compile_options')]
+
+
+# Storage settings of attached databases. Sizes are per database, cache sizes
+# are in KB.
+CACHE_SIZE = 8 * 1024
+BULK_CACHE_SIZE = 64 * 1024  # For databases being built from scratch.
+MMAP_SIZE = 256 * 1024 * 1024
+
+
 class SymbolDatabase(object):
-    has_file_ids = False
+    package_trie = None
+    generation = None  # Generation package_trie was built for.
+    trie_changes = None  # Value of total_changes package_trie was built at.
 
-    def __init__(self, paths):
-        if PERF_DATA_DB:
-            self.db = sqlite3.connect(PERF_DATA_DB)
-            self.cur = InstrumentedCursor(self.db)
-        else:
-            self.db = sqlite3.connect(':memory:')
-            self.cur = self.db.cursor()
+    def __init__(self, paths, readonly=(), bulk=False, snapshot_keys=None):
+        ''' Snapshot keys map indices of snapshots to (Python version,
+        lockfile path) pairs they must have been exported with, either may be
+        None.
+        '''
+        self.db = sqlite3.connect(':memory:')
+        self.cur = self.cursor()
+        self.db.create_function('reversed_name', 3, reversed_name)
 
         # Load specified databases.
-        for dbi, path in enumerate(paths):
+        self.paths = paths
+        self.readonly = frozenset(readonly)  # Indices of snapshots.
+        self.bulk = bulk  # Whether databases are being built from scratch.
+        self.snapshot_keys = snapshot_keys or {}
+        self.errors = []  # Why snapshots could not be used.
+        self.database_count = len(paths)
+        self.interned = {}  # Database index -> caches (see clear_interned).
+        for dbi in xrange(self.database_count):
+            self.attach(dbi)
+
+    def attach(self, dbi):
+        if dbi in self.readonly:
+            try:
+                self.attach_snapshot(dbi)
+            except ValueError as e:
+                # Use an empty database instead, so that indices of others do
+                # not change.
+                self.errors.append(str(e))
+                self.cur.execute('''
+                    ATTACH DATABASE ':memory:' AS ?
+                ''', ('db{0}'.format(dbi),))
+                self.try_create_schema(dbi)
+        else:
             self.cur.execute('''
                 ATTACH DATABASE ? AS ?
-            ''', (path, 'db{0}'.format(dbi)))
+            ''', (self.paths[dbi], 'db{0}'.format(dbi)))
             self.try_create_schema(dbi)
+        self.configure_storage(dbi)
+        self.clear_interned(dbi)
 
-        # Create views of all files and symbols defined in specified databases.
-        self.cur.execute('CREATE TEMP VIEW all_symbols AS ' +
-            ' UNION ALL '.join(
-                'SELECT *, {0} AS dbid FROM db{0}.symbols'.format(dbi)
-                for dbi in xrange(len(paths))))
-        self.cur.execute('CREATE TEMP VIEW all_files AS ' +
-            ' UNION ALL '.join(
-                'SELECT *, {0} AS dbid FROM db{0}.files'.format(dbi)
-                for dbi in xrange(len(paths))))
+    def attach_snapshot(self, dbi):
+        ''' Attach a read-only database (see export_snapshot), leaving its
+        schema as it is.
+        '''
+        path = self.paths[dbi]
+        if not os.path.isfile(path):
+            # Plain ATTACH would create an empty database.
+            raise ValueError('Snapshot {0} does not exist'.format(path))
+        if URI_FILE_NAMES:
+            # Immutable files are not locked, so they can be shared (eg. over
+            # network file systems).
+            path = 'file:{0}?mode=ro&immutable=1'.format(
+                pathname2url(os.path.abspath(path)))
+        self.cur.execute('''
+            ATTACH DATABASE ? AS ?
+        ''', (path, 'db{0}'.format(dbi)))
+
+        try:
+            self.check_snapshot(dbi)
+        except ValueError:
+            self.detach(dbi)
+            raise
+
+    def check_snapshot(self, dbi):
+        path = self.paths[dbi]
+        self.cur.execute('PRAGMA db{0}.user_version'.format(dbi))
+        version = self.cur.fetchone()[0]
+        if version != len(SCHEMA_MIGRATIONS):
+            raise ValueError('Snapshot {0} has schema version {1} instead of '
+                             '{2}, export it again'.format(
+                                 path, version, len(SCHEMA_MIGRATIONS)))
+
+        python_version, lockfile = self.snapshot_keys.get(dbi, (None, None))
+        if python_version is None and lockfile is None:
+            return
+        try:
+            self.cur.execute('''
+                SELECT key, value FROM db{0}.snapshot_info
+            '''.format(dbi))
+        except sqlite3.OperationalError:
+            raise ValueError('{0} is not an exported snapshot'.format(path))
+        info = dict(self.cur)
+
+        if python_version is not None and \
+                info.get('python_version') != python_version:
+            raise ValueError('Snapshot {0} is for Python {1}, not {2}'.format(
+                path, info.get('python_version'), python_version))
+        if lockfile is not None:
+            try:
+                with open(lockfile, 'rb') as f:
+                    lockfile_hash = sha1(f.read()).hexdigest()
+            except IOError as e:
+                raise ValueError('Cannot check snapshot {0}: {1}'.format(
+                    path, e))
+            if info.get('lockfile_hash') != lockfile_hash:
+                raise ValueError('Snapshot {0} was not exported for the '
+                                 'current {1}'.format(path, lockfile))
+
+    def configure_storage(self, dbi):
+        cache_size = BULK_CACHE_SIZE if self.bulk else CACHE_SIZE
+        self.cur.execute('PRAGMA db{0}.cache_size = {1}'.format(dbi,
+                                                               -cache_size))
+        self.cur.execute('PRAGMA db{0}.mmap_size = {1}'.format(dbi,
+                                                              MMAP_SIZE))
+        if dbi in self.readonly:
+            return
+
+        if self.bulk:
+            # Half-built databases are thrown away after a crash anyway, so
+            # there's no point in making commits durable.
+            journal_mode, synchronous = 'MEMORY', 'OFF'
+        else:
+            # Readers (eg. other open database sets) don't block writers
+            # (eg. watchers), and commits don't wait for the disk, only
+            # checkpoints do. Falls back to the default on file systems
+            # without shared memory support.
+            journal_mode, synchronous = 'WAL', 'NORMAL'
+        self.cur.execute('PRAGMA db{0}.journal_mode = {1}'.format(
+            dbi, journal_mode))
+        self.cur.execute('PRAGMA db{0}.synchronous = {1}'.format(
+            dbi, synchronous))
+
+    def detach(self, dbi):
+        self.cur.execute('DETACH DATABASE db{0}'.format(dbi))
+
+    def close(self):
+        self.db.close()
+
+    def rollback(self):
+        self.db.rollback()
+        # Rolled back strings may have been cached.
+        for dbi in xrange(self.database_count):
+            self.clear_interned(dbi)
+
+    def clear_interned(self, dbi):
+        # Caches of interned strings ids: names, packages and (package id,
+        # scope) pairs.
+        self.interned[dbi] = {}, {}, {}
+
+    def cursor(self):
+        if profiler is not None:
+            return InstrumentedCursor(self.db, profiler)
+        else:
+            return self.db.cursor()
 
     def try_create_schema(self, dbi):
+        self.cur.execute('PRAGMA db{0}.user_version'.format(dbi))
+        version = self.cur.fetchone()[0]
+        if version == 0:
+            self.cur.execute(
+                'SELECT count(*) FROM db{0}.sqlite_master'.format(dbi))
+            if not self.cur.fetchone()[0]:
+                self.create_schema(dbi)
+                return
+
+        # Bring older databases up to date.
+        migrated = False
+        for version in xrange(version, len(SCHEMA_MIGRATIONS)):
+            try:
+                self.cur.executescript(
+                    'BEGIN;' + SCHEMA_MIGRATIONS[version].format(dbi) +
+                    'PRAGMA db{0}.user_version = {1}; COMMIT;'.format(
+                        dbi, version + 1))
+            except sqlite3.Error:
+                try:
+                    self.cur.executescript('ROLLBACK;')
+                except sqlite3.Error:
+                    # Failed before the transaction began.
+                    pass
+                raise
+            migrated = True
+        if migrated:
+            # Reclaim space of tables rebuilt by migrations.
+            self.cur.execute('VACUUM db{0}'.format(dbi))
+
+    def create_schema(self, dbi):
+        ''' Create the latest schema in a new database. Databases created
+        before schema versions were introduced (version 0) have only files
+        (with package names) and symbols (with names and scopes) tables.
+        '''
+        # Auto vacuum mode can be changed only before tables are created.
         self.cur.executescript('''
-            CREATE TABLE IF NOT EXISTS db{0}.symbols (
-                file_id INTEGER REFERENCES files(id),
-                symbol TEXT NOT NULL,  -- Symbol name, valid Python identifier.
-                scope TEXT NOT NULL,   -- Scope inside a file (eg. class name).
-                row INTEGER NOT NULL,
-                col INTEGER NOT NULL
+            PRAGMA db{0}.auto_vacuum = INCREMENTAL;
+            BEGIN;
+
+            CREATE TABLE IF NOT EXISTS db{0}.packages (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE   -- Package name (eg. "os.path").
             );
-            CREATE INDEX IF NOT EXISTS db{0}.symbols_symbol ON symbols(symbol);
+
+            CREATE TABLE IF NOT EXISTS db{0}.names (
+                id INTEGER PRIMARY KEY,
+                name TEXT NOT NULL UNIQUE   -- Valid Python identifier.
+            );
+
+            CREATE TABLE IF NOT EXISTS db{0}.scopes (
+                id INTEGER PRIMARY KEY,
+                package_id INTEGER NOT NULL REFERENCES packages(id),
+                scope TEXT NOT NULL,  -- Scope inside a file (eg. class name).
+                rev_namespace TEXT NOT NULL,  -- reversed_name(package, scope).
+                UNIQUE (package_id, scope)
+            );
+            CREATE INDEX IF NOT EXISTS db{0}.scopes_rev_namespace
+                ON scopes(rev_namespace);
 
             CREATE TABLE IF NOT EXISTS db{0}.files (
                 id INTEGER PRIMARY KEY,
                 path TEXT NOT NULL UNIQUE,
-                package TEXT NOT NULL,     -- Package name (eg. "os.path").
-                timestamp REAL NOT NULL    -- Last modification time.
+                package_id INTEGER NOT NULL REFERENCES packages(id),
+                timestamp REAL NOT NULL,  -- Last modification time.
+                size INTEGER,
+                hash TEXT                 -- SHA-1 of contents.
             );
-            CREATE UNIQUE INDEX IF NOT EXISTS db{0}.files_path ON files(path);
-            CREATE INDEX IF NOT EXISTS db{0}.files_package ON files(package);
-        '''.format(dbi))
+            CREATE INDEX IF NOT EXISTS db{0}.files_package ON files(package_id);
 
-    def add(self, dbi, symbol, scope, path, row, col):
-        self.cur.execute('''
-            INSERT INTO db{0}.symbols(file_id, symbol, scope, row, col)
-            VALUES(
-                (SELECT id FROM db{0}.files WHERE path = :path),
-                :symbol, :scope, :row, :col
-            )
+            CREATE TABLE IF NOT EXISTS db{0}.symbols (
+                file_id INTEGER NOT NULL REFERENCES files(id),
+                name_id INTEGER NOT NULL REFERENCES names(id),
+                scope_id INTEGER NOT NULL REFERENCES scopes(id),
+                row INTEGER NOT NULL,
+                col INTEGER NOT NULL
+            );
+            CREATE INDEX IF NOT EXISTS db{0}.symbols_name ON symbols(name_id);
+            CREATE INDEX IF NOT EXISTS db{0}.symbols_scope_name
+                ON symbols(scope_id, name_id);
+            CREATE INDEX IF NOT EXISTS db{0}.symbols_file_id
+                ON symbols(file_id);
+
+            CREATE TRIGGER IF NOT EXISTS db{0}.files_delete
+                AFTER DELETE ON files
+            BEGIN
+                DELETE FROM symbols WHERE file_id = OLD.id;
+            END;
+
+            PRAGMA db{0}.user_version = {1};
+            COMMIT;
+        '''.format(dbi, len(SCHEMA_MIGRATIONS)))
+
+    def intern(self, cache, key, insert_query, select_query, params):
+        ''' Return id of a string (or other value) stored in a table, adding
+        it if needed.
+        '''
+        try:
+            return cache[key]
+        except KeyError:
+            pass
+
+        self.cur.execute(insert_query, params)
+        if self.cur.rowcount == 1:
+            string_id = self.cur.lastrowid
+        else:
+            # Already there, just not cached.
+            self.cur.execute(select_query, params)
+            string_id = self.cur.fetchone()[0]
+        cache[key] = string_id
+        return string_id
+
+    def get_name_id(self, dbi, name):
+        return self.intern(self.interned[dbi][0], name, '''
+            INSERT OR IGNORE INTO db{0}.names(name) VALUES(:name)
+        '''.format(dbi), '''
+            SELECT id FROM db{0}.names WHERE name = :name
         '''.format(dbi), locals())
 
-    def clear_file(self, dbi, name):
-        self.cur.execute('''
-            DELETE FROM db{0}.symbols WHERE
-                file_id = (SELECT id FROM db{0}.files WHERE path = :name)
+    def get_package_id(self, dbi, package):
+        return self.intern(self.interned[dbi][1], package, '''
+            INSERT OR IGNORE INTO db{0}.packages(name) VALUES(:package)
+        '''.format(dbi), '''
+            SELECT id FROM db{0}.packages WHERE name = :package
         '''.format(dbi), locals())
 
-    def begin_file_processing(self, dbi):
-        self.has_file_ids = True
-        self.cur.execute('DROP TABLE IF EXISTS file_ids')
-        self.cur.execute('''
-            CREATE TEMP TABLE file_ids (
-                file_id INTEGER NOT NULL
-            )
-        ''')
+    def get_scope_id(self, dbi, package_id, package, scope):
+        rev_namespace = reversed_name(package, scope)
+        return self.intern(self.interned[dbi][2], (package_id, scope), '''
+            INSERT OR IGNORE INTO db{0}.scopes(package_id, scope,
+                                               rev_namespace)
+            VALUES(:package_id, :scope, :rev_namespace)
+        '''.format(dbi), '''
+            SELECT id FROM db{0}.scopes
+            WHERE package_id = :package_id AND scope = :scope
+        '''.format(dbi), locals())
 
-    def end_file_processing(self, dbi):
-        self.cur.execute('''
-            DELETE FROM db{0}.symbols WHERE file_id NOT IN (
-                SELECT file_id FROM file_ids)
-        '''.format(dbi))
+    def add_symbols(self, dbi, file_id, package, symbols):
+        ''' Add symbols given as (symbol, scope, row, col) tuples. '''
+        package_id = self.get_package_id(dbi, package)
+        rows = [(file_id, self.get_name_id(dbi, symbol),
+                 self.get_scope_id(dbi, package_id, package, scope), row, col)
+                for symbol, scope, row, col in symbols]
+        self.cur.executemany('''
+            INSERT INTO db{0}.symbols(file_id, name_id, scope_id, row, col)
+            VALUES(?, ?, ?, ?, ?)
+        '''.format(dbi), rows)
+
+    def clear_file(self, dbi, file_id):
         self.cur.execute('''
-            DELETE FROM db{0}.files WHERE id NOT IN (
-                SELECT file_id FROM file_ids)
-        '''.format(dbi))
-        self.cur.execute('DROP TABLE file_ids')
-        self.has_file_ids = False
+            DELETE FROM db{0}.symbols WHERE file_id = :file_id
+        '''.format(dbi), locals())
 
-    def update_file_time(self, dbi, path, time):
+    def get_file(self, dbi, path):
+        ''' Return (id, timestamp, size, hash) tuple describing a file, or None
+        if it's not in the database.
+        '''
         self.cur.execute('''
-            SELECT id, timestamp FROM db{0}.files WHERE path = :path
+            SELECT id, timestamp, size, hash FROM db{0}.files
+            WHERE path = :path
         '''.format(dbi), locals())
-        try:
-            file_id, timestamp = self.cur.fetchone()
-        except TypeError:
-            package = get_package(path)
+        return self.cur.fetchone()
+
+    def update_file(self, dbi, file_id, path, package, time, size, hash):
+        ''' Store file data. If file_id is None, a new file is added. Returns
+        file id.
+        '''
+        package_id = self.get_package_id(dbi, package)
+        if file_id is None:
             self.cur.execute('''
-                INSERT INTO db{0}.files(path, package, timestamp)
-                VALUES(:path, :package, :time)
+                INSERT INTO db{0}.files(path, package_id, timestamp, size,
+                                        hash)
+                VALUES(:path, :package_id, :time, :size, :hash)
             '''.format(dbi), locals())
             file_id = self.cur.lastrowid
-            result = True
         else:
-            if timestamp < time:
-                package = get_package(path)
-                self.cur.execute('''
-                    UPDATE db{0}.files
-                    SET timestamp = :time, package = :package
-                    WHERE id = :file_id
-                '''.format(dbi), locals())
-                result = True
-            else:
-                result = False
+            self.cur.execute('''
+                UPDATE db{0}.files
+                SET timestamp = :time, package_id = :package_id, size = :size,
+                    hash = :hash
+                WHERE id = :file_id
+            '''.format(dbi), locals())
+        return file_id
+
+    def touch_file(self, dbi, file_id, time):
+        ''' Update timestamp of a file which contents did not change. '''
+        self.cur.execute('''
+            UPDATE db{0}.files SET timestamp = :time WHERE id = :file_id
+        '''.format(dbi), locals())
 
-        if self.has_file_ids:
-            self.cur.execute('INSERT INTO file_ids VALUES(:file_id)', locals())
+    def file_times(self, dbi):
+        ''' Return dict mapping paths of all files in the database to
+        (file id, timestamp) pairs.
+        '''
+        self.cur.execute('''
+            SELECT path, id, timestamp FROM db{0}.files
+        '''.format(dbi))
+        return dict((row[0], row[1:]) for row in self.cur)
+
+    def remove_files(self, dbi, file_ids):
+        self.cur.execute('DROP TABLE IF EXISTS removed_file_ids')
+        self.cur.execute('''
+            CREATE TEMP TABLE removed_file_ids (
+                file_id INTEGER PRIMARY KEY
+            )
+        ''')
+        self.cur.executemany('''
+            INSERT OR IGNORE INTO removed_file_ids VALUES(?)
+        ''', ((file_id,) for file_id in file_ids))
+        # Symbols are removed by files_delete trigger.
+        self.cur.execute('''
+            DELETE FROM db{0}.files WHERE id IN (
+                SELECT file_id FROM removed_file_ids)
+        '''.format(dbi))
+        self.cur.execute('DROP TABLE removed_file_ids')
 
-        return result
+    def remove_paths(self, dbi, paths):
+        ''' Remove files with given paths, or located in directories with
+        given paths.
+        '''
+        file_ids = []
+        for path in paths:
+            path = os.path.normcase(os.path.normpath(path))
+            path_from = path + os.sep
+            path_to = path + chr(ord(os.sep) + 1)
+            self.cur.execute('''
+                SELECT id FROM db{0}.files WHERE
+                    path = :path OR (path > :path_from AND path < :path_to)
+            '''.format(dbi), locals())
+            file_ids.extend(row[0] for row in self.cur)
+        if file_ids:
+            self.remove_files(dbi, file_ids)
 
     def commit(self):
         self.db.commit()
 
+    def _query_each(self, query, params):
+        ''' Run a query against each attached database separately, so that it
+        can use that database's indexes. "{0}" in query is replaced with
+        database index. Query results must be sorted, they're merged into one
+        sorted sequence.
+        '''
+        cursors = []
+        for dbi in xrange(self.database_count):
+            cur = self.cursor()
+            cur.execute(query.format(dbi), params)
+            cursors.append(cur)
+        return merge(*cursors)
+
     def _result_row_to_dict(self, row):
         return {
             'symbol': row[0],
-            'scope': row[1],
-            'package': row[2],
-            'row': row[3],
-            'col': row[4],
-            'file': row[5]
+            'file': row[1],
+            'row': row[2],
+            'col': row[3],
+            'scope': row[4],
+            'package': row[5]
         }
 
     def occurrences(self, symbol):
-        namespace, sep, symbol = symbol.rpartition('.')
-        if sep:
-            namespace = '*.' + namespace
+        for row in self.occurrence_rows(symbol):
+            yield self._result_row_to_dict(row)
+
+    def occurrence_rows(self, symbol):
+        ''' Same as occurrences, but yields (symbol, path, row, col, scope,
+        package) tuples.
+        '''
+        namespace, sep, name = symbol.rpartition('.')
+        if namespace:
+            # Symbol namespace (package and scope) must end with the given
+            # one, ie. reversed namespace must start with reversed query.
+            # Matching scopes are few even for common names, so the lookup
+            # starts from them (CROSS JOIN keeps the planner from starting
+            # from all symbols with the name).
+            namespace_from = reversed_name(namespace)
+            namespace_to = namespace_from[:-1] + chr(ord('.') + 1)
+            tables = '''
+                db{0}.scopes c CROSS JOIN db{0}.names n
+                CROSS JOIN db{0}.symbols s
+            '''
+            condition = '''
+                c.rev_namespace >= :namespace_from AND
+                c.rev_namespace < :namespace_to AND
+            '''
         else:
-            namespace = '*'
+            tables = 'db{0}.names n, db{0}.symbols s, db{0}.scopes c'
+            condition = ''
 
-        self.cur.execute('''
-            SELECT s.symbol, s.scope, f.package, s.row, s.col, f.path
-            FROM all_symbols s, all_files f
+        return self._query_each('''
+            SELECT n.name, f.path, s.row, s.col, c.scope, p.name
+            FROM ''' + tables + ''', db{0}.files f, db{0}.packages p
             WHERE
-                s.file_id = f.id AND
-                s.dbid = f.dbid AND
-                s.symbol = :symbol AND
-                '.' || f.package || '.' || s.scope GLOB :namespace
-            ORDER BY s.symbol, f.path, s.row
+                ''' + condition + '''
+                n.name = :name AND
+                s.name_id = n.id AND
+                s.scope_id = c.id AND
+                f.id = s.file_id AND
+                p.id = c.package_id
+            ORDER BY n.name, f.path, s.row, s.col, c.scope, p.name
         ''', locals())
-        for row in self.cur:
-            yield self._result_row_to_dict(row)
 
     def members(self, package, prefix):
-        self.cur.execute('''
-            SELECT DISTINCT s.symbol
-            FROM all_symbols s, all_files f
+        rows = self._query_each('''
+            SELECT DISTINCT n.name
+            FROM db{0}.packages p, db{0}.scopes c, db{0}.symbols s,
+                db{0}.names n
             WHERE
-                s.file_id = f.id AND
-                s.dbid = f.dbid AND
-                f.package = :package AND
-                s.symbol GLOB :prefix || '*' AND
-                s.scope = ''
-            ORDER BY s.symbol, f.path, s.row
+                p.name = :package AND
+                c.package_id = p.id AND
+                c.scope = '' AND
+                s.scope_id = c.id AND
+                n.id = s.name_id AND
+                n.name GLOB :prefix || '*'
+            ORDER BY n.name
         ''', locals())
-        return (row[0] for row in self.cur)
+        return (row[0] for row, group in groupby(rows))
 
     def packages(self, prefix):
-        self.cur.execute('''
-            SELECT DISTINCT package
-            FROM all_files
-            WHERE package GLOB :prefix || '*'
+        # Packages of removed files are left behind, skip them.
+        rows = self._query_each('''
+            SELECT p.name
+            FROM db{0}.packages p
+            WHERE
+                p.name GLOB :prefix || '*' AND
+                EXISTS (SELECT 1 FROM db{0}.files f WHERE f.package_id = p.id)
+            ORDER BY p.name
         ''', locals())
-        return (row[0] for row in self.cur)
+        return (row[0] for row, group in groupby(rows))
+
+    def package_components(self, prefix):
+        # Changes made through this connection since the trie was built are
+        # noticed here, others by checking generation (see
+        # query_package_components).
+        if self.package_trie is None or \
+                self.db.total_changes != self.trie_changes:
+            self.trie_changes = self.db.total_changes
+            self.package_trie = PackageTrie(self.packages(''))
+        return self.package_trie.components(prefix)
+
+    def maintain(self, dbi):
+        ''' Remove strings no longer referenced, release free pages, update
+        statistics used by the query planner and move write-ahead log contents
+        into the database file. Interned strings cached by other connections
+        become invalid.
+        '''
+        self.cur.execute('''
+            DELETE FROM db{0}.scopes WHERE NOT EXISTS (
+                SELECT 1 FROM db{0}.symbols WHERE scope_id = scopes.id)
+        '''.format(dbi))
+        self.cur.execute('''
+            DELETE FROM db{0}.names WHERE NOT EXISTS (
+                SELECT 1 FROM db{0}.symbols WHERE name_id = names.id)
+        '''.format(dbi))
+        self.cur.execute('''
+            DELETE FROM db{0}.packages
+            WHERE NOT EXISTS (
+                SELECT 1 FROM db{0}.files WHERE package_id = packages.id)
+            AND NOT EXISTS (
+                SELECT 1 FROM db{0}.scopes WHERE package_id = packages.id)
+        '''.format(dbi))
+        self.commit()
+        self.clear_interned(dbi)
+
+        self.cur.execute('PRAGMA db{0}.incremental_vacuum'.format(dbi))
+        self.cur.fetchall()
+        self.cur.execute('ANALYZE db{0}'.format(dbi))
+        self.commit()
+        self.cur.execute('PRAGMA db{0}.wal_checkpoint(TRUNCATE)'.format(dbi))
+        self.cur.fetchall()
+
+    def storage_stats(self, dbi):
+        ''' Return dict describing size and fragmentation of a database. '''
+        stats = {'path': self.paths[dbi]}
+        for pragma in ('journal_mode', 'page_size', 'page_count',
+                       'freelist_count'):
+            self.cur.execute('PRAGMA db{0}.{1}'.format(dbi, pragma))
+            stats[pragma] = self.cur.fetchone()[0]
+        for table in ('files', 'symbols', 'names', 'scopes', 'packages'):
+            self.cur.execute('SELECT count(*) FROM db{0}.{1}'.format(dbi,
+                                                                   table))
+            stats[table] = self.cur.fetchone()[0]
+        self.cur.execute('''
+            SELECT count(*) FROM db{0}.sqlite_master
+            WHERE name = 'sqlite_stat1'
+        '''.format(dbi))
+        stats['analyzed'] = bool(self.cur.fetchone()[0])
+        try:
+            stats['wal_size'] = os.path.getsize(self.paths[dbi] + '-wal')
+        except OSError:
+            stats['wal_size'] = 0
+        return stats
 
 
 class SymbolExtractor(ast.NodeVisitor):
-    def __init__(self, db, dbi, path):
-        self.path = path
-        self.db = db
-        self.dbi = dbi
+    def __init__(self):
+        self.symbols = []  # List of (symbol, scope, row, col) tuples.
         self.scope = []
         self.this = None
 
@@ -277,46 +960,1150 @@ class SymbolExtractor(ast.NodeVisitor):
                 self.add_symbol(target.id, target)
 
     def add_symbol(self, name, node):
-        self.db.add(self.dbi, name, '.'.join(self.scope), self.path,
-                    node.lineno - 1, node.col_offset)
+        self.symbols.append((name, '.'.join(self.scope), node.lineno - 1,
+                             node.col_offset))
+
+
+# Symbol extraction without building the syntax tree, for large (usually
+# generated) files. The source is split into logical lines of top-level tokens,
+# with bracketed expressions skipped as single tokens, since symbols are found
+# only in statement headers and assignment targets. Gives the same results as
+# SymbolExtractor for valid code.
+
+# Files at least that large (in bytes) are scanned by scan_symbols.
+SCAN_MIN_SIZE = 64 * 1024
+
+STRING_PATTERN = r'''
+    \'\'\'[^'\\]*(?:(?:\\.|'(?!''))[^'\\]*)*\'\'\'
+  | """[^"\\]*(?:(?:\\.|"(?!""))[^"\\]*)*"""
+  | '[^'\\\n]*(?:\\.[^'\\\n]*)*'
+  | "[^"\\\n]*(?:\\.[^"\\\n]*)*"
+'''
+
+# Tokens outside of brackets. String prefixes are scanned as words, which
+# doesn't matter since strings can't be a part of a symbol definition.
+SCAN_TOKEN_REGEX = re.compile(r'''
+    (?P<newline>\n)
+  | (?P<space>[ \t\f]+|\\\n)
+  | (?P<comment>\#[^\n]*)
+  | (?P<word>\w+)
+  | (?P<open>[(\[{])
+  | (?P<string>''' + STRING_PATTERN + r''')
+  | (?P<op>\*\*=?|//=?|>>=?|<<=?|[-+*/%&|^<>!=]=|<>|[-+*/%&|^~<>=.,:;@`])
+''', re.VERBOSE | re.DOTALL)
+
+# Tokens inside brackets, only the brackets matter.
+SCAN_BRACKET_REGEX = re.compile(r'''
+    [^'"\#()\[\]{}]+
+  | \#[^\n]*
+  | (?P<open>[(\[{])
+  | (?P<close>[)\]}])
+  | ''' + STRING_PATTERN, re.VERBOSE | re.DOTALL)
+
+COMPOUND_KEYWORDS = frozenset(['if', 'elif', 'else', 'for', 'while', 'try',
+                               'except', 'finally', 'with', 'def', 'class'])
+
+
+def scan_tokens(source, pos, end):
+    ''' Yield (kind, value, position) tuples of top-level tokens in
+    source[pos:end]. Bracketed expressions are "group" tokens, with position
+    past the closing bracket as value. Raises SyntaxError if the source can't
+    be tokenized.
+    '''
+    match_token = SCAN_TOKEN_REGEX.match
+    match_bracket = SCAN_BRACKET_REGEX.match
+    while pos < end:
+        match = match_token(source, pos, end)
+        if match is None:
+            raise SyntaxError('invalid token at {0}'.format(pos))
+        kind = match.lastgroup
+        start, pos = match.span()
+        if kind == 'open':
+            depth = 1
+            while depth:
+                match = match_bracket(source, pos, end)
+                if match is None:
+                    raise SyntaxError('unclosed bracket at {0}'.format(start))
+                pos = match.end()
+                if match.lastgroup == 'open':
+                    depth += 1
+                elif match.lastgroup == 'close':
+                    depth -= 1
+            yield 'group', pos, start
+        elif kind != 'space' and kind != 'comment':
+            yield kind, match.group(), start
+
+
+class SymbolScanner(object):
+    ''' Extracts the same (symbol, scope, row, col) tuples as SymbolExtractor
+    from source code. scan raises SyntaxError if the source can't be scanned.
+    '''
+
+    def __init__(self, source):
+        if '\r' in source:
+            source = source.replace('\r\n', '\n').replace('\r', '\n')
+        self.source = source
+        self.symbols = []
+        # (indentation, kind, scope) of open blocks. Kind is "def" in function
+        # bodies (which are skipped) and "class" elsewhere, module included.
+        self.blocks = [(0, 'class', '')]
+        self.pending = None  # (kind, scope) of block opened by the last line.
+        self.decorator = None  # (row, col) of decorators of the next def.
+        self.offset = self.row = self.line_start = 0  # Last located offset.
+
+    def scan(self):
+        line = []
+        for token in scan_tokens(self.source, 0, len(self.source)):
+            if token[0] != 'newline':
+                line.append(token)
+            elif line:
+                self.process_line(line)
+                line = []
+        if line:
+            self.process_line(line)
+
+    def locate(self, offset):
+        ''' Return (row, col) of an offset, offsets must not decrease. '''
+        self.row += self.source.count('\n', self.offset, offset)
+        self.offset = offset
+        self.line_start = self.source.rfind('\n', 0, offset) + 1
+        return self.row, offset - self.line_start
+
+    def get_indentation(self, offset):
+        self.locate(offset)
+        indentation = self.source[self.line_start:offset]
+        # Form feed resets indentation, as in Python tokenizer.
+        return len(indentation.rpartition('\f')[2].expandtabs(8))
+
+    def process_line(self, line):
+        # Open or close blocks.
+        indentation = self.get_indentation(line[0][2])
+        if self.pending is not None:
+            if indentation <= self.blocks[-1][0]:
+                raise SyntaxError('expected an indented block')
+            self.blocks.append((indentation,) + self.pending)
+            self.pending = None
+        else:
+            while indentation < self.blocks[-1][0]:
+                self.blocks.pop()
+            if indentation != self.blocks[-1][0]:
+                raise SyntaxError('inconsistent indentation')
+        kind, scope = self.blocks[-1][1:]
+
+        first_kind, first_value, first_pos = line[0]
+        if first_value == '@' and first_kind == 'op':
+            if self.decorator is None:
+                self.decorator = self.locate(first_pos)
+            return
+
+        if first_kind == 'word' and first_value in COMPOUND_KEYWORDS:
+            colon = self.find_header_colon(line)
+            if first_value in ('def', 'class'):
+                if len(line) < 3 or line[1][0] != 'word':
+                    raise SyntaxError('invalid definition')
+                name = line[1][1]
+                if kind == 'class':
+                    self.symbols.append(
+                        (name, scope) +
+                        (self.decorator or self.locate(first_pos)))
+                self.decorator = None
+                if first_value == 'def':
+                    kind = 'def'
+                elif kind == 'class':
+                    scope = '.'.join(filter(None, (scope, name)))
+            if colon == len(line) - 1:
+                self.pending = kind, scope
+                return
+            # Simple statements following the colon.
+            line = line[colon + 1:]
+
+        if kind == 'class':
+            self.process_statements(line, scope)
+
+    @staticmethod
+    def find_header_colon(line):
+        lambdas = 0  # Number of lambdas waiting for their colons.
+        for i, (kind, value, pos) in enumerate(line):
+            if kind == 'word' and value == 'lambda':
+                lambdas += 1
+            elif kind == 'op' and value == ':':
+                if not lambdas:
+                    return i
+                lambdas -= 1
+        raise SyntaxError('expected a colon')
+
+    def process_statements(self, line, scope):
+        ''' Add targets of assignments among ;-separated statements. '''
+        targets_start = 0
+        in_value = False  # Past a lambda, "=" may only be part of value.
+        for i, (kind, value, pos) in enumerate(line):
+            if kind == 'op':
+                if value == '=' and not in_value:
+                    self.add_targets(line[targets_start:i], scope)
+                    targets_start = i + 1
+                elif value == ';':
+                    targets_start = i + 1
+                    in_value = False
+            elif kind == 'word' and value == 'lambda':
+                in_value = True
+
+    def add_targets(self, tokens, scope):
+        ''' Add names assigned by an assignment target, which may be a tuple
+        or a list of other targets.
+        '''
+        element = []
+        for token in tokens + [('op', ',', None)]:
+            if token[1] != ',' or token[0] != 'op':
+                element.append(token)
+                continue
+            if len(element) == 1:
+                kind, value, pos = element[0]
+                if kind == 'word' and not value[0].isdigit():
+                    self.symbols.append((value, scope) + self.locate(pos))
+                elif kind == 'group' and self.source[pos] in '([':
+                    # Parenthesized target, tuple or list.
+                    self.add_targets([inner for inner in scan_tokens(
+                        self.source, pos + 1, value - 1)
+                        if inner[0] != 'newline'], scope)
+            # Attributes and subscripts are not symbols.
+            element = []
+
+
+# Parallel parsing. Parsing and symbol extraction are CPU bound and independent
+# for each file, so they're done by a pool of worker processes. Workers only
+# return compact symbol batches, all database writes are done by this process.
+
+# Minimal number of files worth sending to the parser pool, smaller batches are
+# parsed in-process.
+PARALLEL_MIN_FILES = 4
+
+# Number of files sent to a parser worker at once.
+PARALLEL_CHUNK_SIZE = 8
+
+parser_pool = None
+parser_pool_lock = Lock()  # Pool is shared by watcher threads.
+
+
+def parse_file(job):
+    ''' Parse a file and extract its symbols. Takes (path, known_hash) pair and
+    returns (path, hash, symbols, parse time) tuple. Symbols are None if the
+    file could not be parsed, or if its contents hash matches known_hash, in
+    which case it's not parsed at all. Executed by parser workers, so it must
+    not touch the database.
+    '''
+    path, known_hash = job
+    begin = time()
+    try:
+        source = open(path).read()
+    except IOError:
+        return path, None, None, 0
+
+    file_hash = sha1(source).hexdigest()
+    if file_hash == known_hash:
+        return path, file_hash, None, time() - begin
+
+    if len(source) >= SCAN_MIN_SIZE:
+        scanner = SymbolScanner(source)
+        try:
+            scanner.scan()
+        except SyntaxError:
+            # Let the parser decide if it's valid code.
+            pass
+        else:
+            return path, file_hash, scanner.symbols, time() - begin
+
+    try:
+        file_ast = ast.parse(source, path)
+    except:
+        return path, file_hash, None, time() - begin
+    extractor = SymbolExtractor()
+    extractor.visit(file_ast)
+    return path, file_hash, extractor.symbols, time() - begin
+
+
+def get_parser_pool():
+    global parser_pool, Pool
+    with parser_pool_lock:
+        if parser_pool is None and Pool is not None:
+            try:
+                parser_pool = Pool()
+            except (OSError, NotImplementedError):
+                # Platform lacks working multiprocessing primitives (eg. no
+                # /dev/shm), fall back to parsing in-process.
+                Pool = None
+    return parser_pool
+
+
+@atexit.register
+def close_parser_pool():
+    ''' Stop parser workers. Files are parsed in-process afterwards. '''
+    global parser_pool, Pool
+    with parser_pool_lock:
+        Pool = None
+        if parser_pool is not None:
+            parser_pool.terminate()
+            parser_pool.join()
+            parser_pool = None
+
+
+def parse_files(jobs):
+    ''' Parse multiple files, yielding parse_file results in arbitrary
+    order.
+    '''
+    if len(jobs) >= PARALLEL_MIN_FILES:
+        pool = get_parser_pool()
+        if pool is not None:
+            return pool.imap_unordered(parse_file, jobs, PARALLEL_CHUNK_SIZE)
+    return (parse_file(job) for job in jobs)
+
+
+def rank_occurrences(rows, file_name=None, project_folders=()):
+    ''' Sort occurrence rows by relevance to a file being edited: those in
+    its project folders go first, then those with paths closer to the file,
+    then those with shallower scopes.
+    '''
+    def normalize(path):
+        return os.path.normcase(os.path.normpath(path))
+
+    project_folders = [normalize(folder) + os.sep
+                       for folder in project_folders]
+    if file_name:
+        file_dirs = normalize(file_name).split(os.sep)[:-1]
+    else:
+        file_dirs = []
+
+    def rank(row):
+        path = row[1]
+        in_project = any(path.startswith(folder)
+                         for folder in project_folders)
+
+        common_dirs = 0
+        for file_dir, result_dir in izip(file_dirs, path.split(os.sep)):
+            if file_dir != result_dir:
+                break
+            common_dirs += 1
+
+        scope = row[4]
+        depth = scope.count('.') + 1 if scope else 0
+
+        return not in_project, -common_dirs, depth, row
+
+    return sorted(rows, key=rank)
+
+
+def get_changed_files(db, dbi, paths):
+    ''' Return dict of files that are new or were modified since they were
+    indexed, path -> (file id, mtime, size, known hash).
+    '''
+    files = {}
+    for path in paths:
+        path = os.path.normcase(os.path.normpath(path))
+        try:
+            stat = os.stat(path)
+        except OSError:
+            # File was removed after being listed.
+            continue
+
+        entry = db.get_file(dbi, path)
+        if entry is None:
+            file_id = known_hash = None
+        else:
+            file_id, timestamp, size, known_hash = entry
+            if timestamp >= stat.st_mtime:
+                continue
+            if size != stat.st_size:
+                # No need to compare hashes.
+                known_hash = None
+
+        files[path] = file_id, stat.st_mtime, stat.st_size, known_hash
+    return files
+
+
+def parse_changed_files(files):
+    ''' Parse files returned by get_changed_files, see parse_files. '''
+    return parse_files([(path, entry[3]) for path, entry in files.iteritems()])
+
+
+def index_files(db, dbi, paths, packages=None, parsed=None):
+    ''' Index files that are new or were modified since they were indexed.
+    Files are parsed in parallel, while the results are written. Module
+    packages are computed by given PackageResolver. Returns list of paths that
+    got indexed.
+
+    Parsed is a (files, results) pair of get_changed_files and
+    parse_changed_files results obtained earlier for the same paths. These are
+    used, unless some of the files changed in the meantime.
+    '''
+    if packages is None:
+        packages = PackageResolver()
+    files = get_changed_files(db, dbi, paths)
+    if parsed is not None and parsed[0] == files:
+        results = parsed[1]
+    else:
+        results = parse_changed_files(files)
+
+    indexed = []
+    for path, file_hash, symbols, parse_time in results:
+        file_id, mtime, size, known_hash = files[path]
+        if file_hash is not None and file_hash == known_hash:
+            # File was only touched, eg. by a VCS checkout.
+            db.touch_file(dbi, file_id, mtime)
+            continue
+
+        begin = time()
+        if file_id is not None:
+            db.clear_file(dbi, file_id)
+        package = packages.get_package(path)
+        file_id = db.update_file(dbi, file_id, path, package, mtime, size,
+                                 file_hash)
+        # Files that cannot be parsed are still recorded, so they're not
+        # retried until modified.
+        if symbols is not None:
+            db.add_symbols(dbi, file_id, package, symbols)
+            indexed.append(path)
+
+        current_profiler = profiler
+        if current_profiler is not None:
+            current_profiler.add_file(path, parse_time, time() - begin,
+                                      len(symbols or ()))
+    return indexed
+
+
+def compile_exclude(exclude):
+    ''' Compile list of directory name globs into a regex matching any of them
+    (None if the list is empty), to be passed to walk_tree.
+    '''
+    if not exclude:
+        return None
+    return re.compile('|'.join('(?:{0})'.format(
+        fnmatch.translate(os.path.normcase(glob))) for glob in exclude))
+
+
+def walk_tree(root, exclude=None, follow_symlinks=False):
+    ''' Walk a directory tree like os.walk, but skip directories with names
+    matching exclude regex and list only Python source files. Yields
+    (directory, files) pairs, where files are lists of (file name, modification
+    time) pairs. Directories are yielded before their subdirectories.
+    '''
+    visited = set()  # Real paths of walked directories, to break link cycles.
+    directories = [root]
+    while directories:
+        directory = directories.pop()
+        if follow_symlinks:
+            real_path = os.path.realpath(directory)
+            if real_path in visited:
+                continue
+            visited.add(real_path)
+
+        files = []
+        try:
+            if scandir is not None:
+                subdirs = scan_directory(directory, exclude, follow_symlinks,
+                                         files)
+            else:
+                subdirs = list_directory(directory, exclude, follow_symlinks,
+                                         files)
+        except OSError:
+            # Directory is gone or inaccessible.
+            continue
+        yield directory, files
+        directories.extend(reversed(subdirs))
+
+
+def scan_directory(directory, exclude, follow_symlinks, files):
+    ''' Implementation of walk_tree step using scandir, which avoids stat
+    calls for most entries. Appends files to files, returns subdirectories.
+    '''
+    subdirs = []
+    for entry in scandir(directory):
+        name = entry.name
+        if entry.is_dir(follow_symlinks=follow_symlinks):
+            if exclude is None or not exclude.match(os.path.normcase(name)):
+                subdirs.append(entry.path)
+        elif is_python_source_file(name):
+            try:
+                files.append((name, entry.stat().st_mtime))
+            except OSError:
+                # Broken symlink or file is gone.
+                pass
+    return subdirs
+
+
+def list_directory(directory, exclude, follow_symlinks, files):
+    ''' Same as scan_directory, but uses os.listdir. '''
+    subdirs = []
+    for name in os.listdir(directory):
+        path = os.path.join(directory, name)
+        if is_python_source_file(name):
+            try:
+                stat = os.stat(path)
+            except OSError:
+                continue
+            if not S_ISDIR(stat.st_mode):
+                files.append((name, stat.st_mtime))
+                continue
+
+        # Test names first, excluded entries don't need to be stat'ed.
+        if exclude is not None and exclude.match(os.path.normcase(name)):
+            continue
+        if os.path.isdir(path) and \
+                (follow_symlinks or not os.path.islink(path)):
+            subdirs.append(path)
+    return subdirs
+
+
+def find_changed_files(db, dbi, roots, pattern=None, exclude=(),
+                       follow_symlinks=False, packages=None):
+    ''' Walk roots looking for Python files (with paths matching the pattern,
+    if given, and skipping directories matching exclude globs) and compare them
+    against the database in one go. Files that are gone are removed from the
+    database. Walked directories are added to packages (a PackageResolver), if
+    given. Returns list of paths of files that are new or were modified since
+    they were indexed (to be passed to index_files).
+    '''
+    if pattern:
+        pattern = re.compile(pattern)
+    exclude = compile_exclude(exclude)
+    known = db.file_times(dbi)
+    seen = set()
+    changed = []
+    for symbol_root in roots:
+        for directory, files in walk_tree(os.path.abspath(symbol_root),
+                                          exclude, follow_symlinks):
+            norm_directory = os.path.normcase(os.path.normpath(directory))
+            if packages is not None:
+                packages.add_directory(norm_directory, any(
+                    file_name == '__init__.py' for file_name, mtime in files))
+            for file_name, mtime in files:
+                if pattern and \
+                        not pattern.search(os.path.join(directory, file_name)):
+                    continue
+
+                path = os.path.join(norm_directory,
+                                    os.path.normcase(file_name))
+                if path in seen:
+                    # Roots overlap.
+                    continue
+                seen.add(path)
+
+                entry = known.pop(path, None)
+                if entry is None or entry[1] < mtime:
+                    changed.append(path)
+
+    # Whatever was not found is gone.
+    if known:
+        db.remove_files(dbi, [file_id for file_id, timestamp
+                              in known.itervalues()])
+    return changed
+
+
+# Watch mode. Watchers are threads that follow file system events under roots
+# of a database and index changed files right away. Each one uses its own
+# database connection.
+
+# Seconds without events after which collected changes get indexed.
+WATCH_DEBOUNCE = 0.5
+
+# Maximum number of seconds changes wait for indexing while events keep coming
+# (eg. during a checkout).
+WATCH_MAX_DELAY = 5.0
+
+# How often watchers check for new roots when idle.
+WATCH_IDLE_TIMEOUT = 1.0
+
+# Number of changed files parsed before their symbols are written.
+WATCH_CHUNK_SIZE = 256
+
+# How often roots are scanned for changes by watchers that could not watch all
+# directories (eg. due to fs.inotify.max_user_watches limit).
+WATCH_RESCAN_INTERVAL = 60.0
+
+if Inotify is not None:
+    WATCH_MASK = IN_CLOSE_WRITE | IN_CREATE | IN_DELETE | IN_MOVED_FROM | \
+        IN_MOVED_TO | IN_ONLYDIR
+
+
+class Watcher(Thread):
+    def __init__(self, path, pattern, exclude, follow_symlinks,
+                 namespace_packages):
+        Thread.__init__(self)
+        self.daemon = True
+        self.path = path
+        self.pattern = pattern
+        self.regex = pattern and re.compile(pattern)
+        self.exclude = exclude
+        self.exclude_regex = compile_exclude(exclude)
+        self.follow_symlinks = follow_symlinks
+        self.namespace_packages = namespace_packages
+        self.roots = []
+        self.new_roots = Queue()
+        self.watched = {}  # Watch descriptor -> directory.
+        self.reopen = False  # Whether database file was replaced.
+        self.incomplete = False  # Whether some directories are not watched.
+        self.error = None  # Error not reported yet, see get_watch_errors.
+        self.scan_time = 0  # When roots were scanned for changes last time.
+        self.stopped = False
+        self.lock = Lock()  # Held while database is open, see watcher_paused.
+
+    def add_roots(self, roots):
+        for root in roots:
+            self.new_roots.put(os.path.abspath(root))
+
+    def matches(self, path):
+        return is_python_source_file(path) and \
+            (not self.regex or self.regex.search(path))
+
+    def run(self):
+        self.inotify = Inotify()
+        pending = set()
+        rescan = False  # Whether changes need to be found by scanning roots.
+        first_change = None
+
+        while not self.stopped:
+            roots = []
+            while not self.new_roots.empty():
+                root = self.new_roots.get()
+                if root not in self.roots and root not in roots:
+                    roots.append(root)
+            if roots:
+                self.roots.extend(roots)
+                for root in roots:
+                    self.watch_tree(root)
+                # Catch up with changes made before watching started.
+                rescan = True
+
+            if self.reopen:
+                # Database was rebuilt, changes made to the old one are lost.
+                self.reopen = False
+                rescan = bool(self.roots)
+            if self.incomplete and \
+                    time() - self.scan_time >= WATCH_RESCAN_INTERVAL:
+                # Changes in unwatched directories are found only this way.
+                rescan = True
+
+            if pending or rescan:
+                if first_change is None:
+                    first_change = time()
+                timeout = max(0, min(WATCH_DEBOUNCE,
+                                     first_change + WATCH_MAX_DELAY - time()))
+            else:
+                timeout = WATCH_IDLE_TIMEOUT
+
+            events = self.inotify.read(timeout)
+            for wd, mask, name in events:
+                if mask & IN_Q_OVERFLOW:
+                    # Some events were lost.
+                    rescan = True
+                else:
+                    self.handle_event(wd, mask, name, pending)
+            if (pending or rescan) and first_change is None:
+                first_change = time()
+
+            if (pending or rescan) and (
+                    not events or time() - first_change >= WATCH_MAX_DELAY):
+                packages = PackageResolver(self.roots,
+                                           self.namespace_packages)
+                if rescan:
+                    self.scan_time = time()
+                if self.index(pending, rescan, packages):
+                    pending = set()
+                    rescan = False
+                    first_change = None
+                else:
+                    # Try again later.
+                    first_change = time()
+        self.inotify.close()
+
+    def stop(self):
+        ''' Stop watching. Waits for the chunk of files being indexed, changes
+        not indexed yet are found by the next scan.
+        '''
+        self.stopped = True
+        self.join()
+
+    def watch_tree(self, root, pending=None):
+        ''' Watch directories under root. Files found there are added to
+        pending set, if given.
+        '''
+        for directory, files in walk_tree(root, self.exclude_regex,
+                                          self.follow_symlinks):
+            try:
+                self.watched[self.inotify.add_watch(directory,
+                                                    WATCH_MASK)] = directory
+            except OSError as e:
+                if e.errno in (errno.ENOSPC, errno.ENOMEM) and \
+                        not self.incomplete:
+                    self.incomplete = True
+                    self.error = (
+                        'Cannot watch all directories of {0} ({1} watched, '
+                        'see fs.inotify.max_user_watches), looking for '
+                        'changes every {2:.0f} s'.format(
+                            self.path, len(self.watched),
+                            WATCH_RESCAN_INTERVAL))
+                # Otherwise directory is gone.
+            if pending is not None:
+                for file_name, mtime in files:
+                    path = os.path.join(directory, file_name)
+                    if self.matches(path):
+                        pending.add(path)
+
+    def handle_event(self, wd, mask, name, pending):
+        directory = self.watched.get(wd)
+        if directory is None:
+            return
+        if mask & IN_IGNORED:
+            del self.watched[wd]
+            return
+
+        path = os.path.join(directory, name)
+        if mask & IN_ISDIR:
+            if mask & (IN_CREATE | IN_MOVED_TO):
+                if self.exclude_regex is None or \
+                        not self.exclude_regex.match(os.path.normcase(name)):
+                    # Files could be created before the directory got
+                    # watched, index them too.
+                    self.watch_tree(path, pending)
+            elif mask & (IN_DELETE | IN_MOVED_FROM):
+                pending.add(path)
+        elif self.matches(path):
+            pending.add(path)
+
+    @contextmanager
+    def database(self):
+        ''' Open the database. Keeping it open only while it's read or written
+        lets others (eg. finish_rebuild) replace it in the meantime.
+        '''
+        with self.lock:
+            db = SymbolDatabase([self.path])
+            try:
+                yield db
+            except sqlite3.OperationalError:
+                db.rollback()
+                raise
+            finally:
+                db.close()
+
+    def index(self, paths, rescan, packages):
+        ''' Index changed paths, after finding more of them by scanning roots
+        if rescan is set. Files are parsed in chunks while the database is not
+        open, so that neither the write transaction nor the lock is held while
+        parsing. Returns False if the database is locked by another connection
+        (eg. index is being built) or was replaced, or the watcher was stopped.
+        '''
+        try:
+            with self.database() as db:
+                if self.reopen:
+                    return False
+                paths = set(paths)
+                if rescan:
+                    paths.update(find_changed_files(
+                        db, 0, self.roots, self.pattern, self.exclude,
+                        self.follow_symlinks, packages))
+                db.remove_paths(0, [path for path in paths
+                                    if not os.path.exists(path)])
+                db.commit()
+                files = get_changed_files(db, 0, [path for path in paths
+                                                  if os.path.isfile(path)])
+            database_changed()
+
+            changed = sorted(files)
+            for i in xrange(0, len(changed), WATCH_CHUNK_SIZE):
+                if self.stopped:
+                    return False
+                chunk = changed[i:i + WATCH_CHUNK_SIZE]
+                chunk_files = dict((path, files[path]) for path in chunk)
+                parsed = chunk_files, list(parse_changed_files(chunk_files))
+                with self.database() as db:
+                    if self.reopen:
+                        return False
+                    index_files(db, 0, chunk, packages, parsed)
+                    db.commit()
+                database_changed()
+        except sqlite3.OperationalError:
+            return False
+        return True
+
+
+def database_changed():
+    ''' Called after databases were modified by a watcher. '''
+    global generation
+    generation = next(generations)
+
+
+def export_snapshot(source, destination, python_version, lockfile_hash):
+    ''' Write a compacted and analyzed copy of source database, to be attached
+    read-only. Python version and lockfile hash identifying what was indexed
+    are stored in its snapshot_info table.
+    '''
+    if os.path.exists(destination):
+        os.remove(destination)
+
+    source_db = SymbolDatabase([source])  # Brings the schema up to date.
+    try:
+        vacuumed = sqlite3.sqlite_version_info >= (3, 27)
+        if vacuumed:
+            source_db.cur.execute('VACUUM db0 INTO ?', (destination,))
+        else:
+            # Copy must include contents of the write-ahead log.
+            source_db.cur.execute('PRAGMA db0.wal_checkpoint(TRUNCATE)')
+            source_db.cur.fetchall()
+            shutil.copyfile(source, destination)
+    finally:
+        source_db.close()
+
+    snapshot = sqlite3.connect(destination)
+    try:
+        snapshot.executescript('''
+            PRAGMA journal_mode = DELETE;
+            DROP TABLE IF EXISTS snapshot_info;
+            CREATE TABLE snapshot_info (
+                key TEXT PRIMARY KEY,
+                value TEXT NOT NULL
+            );
+        ''')
+        snapshot.executemany('''
+            INSERT INTO snapshot_info VALUES (?, ?)
+        ''', [('python_version', python_version),
+              ('lockfile_hash', lockfile_hash),
+              ('source', os.path.abspath(source)),
+              ('created', repr(time()))])
+        snapshot.commit()
+        # Statistics for the query planner, read-only files can't get them.
+        snapshot.execute('ANALYZE')
+        snapshot.commit()
+        if not vacuumed:
+            snapshot.execute('VACUUM')
+    finally:
+        snapshot.close()
 
 
 # Functions served as LPCs.
 
 db = None
 
+# Number identifying committed contents of databases, so that the plugin can
+# tell whether its cached query results are still valid. Generations start
+# from process start time, so they do not repeat when the process restarts.
+generations = count(int(time() * 1000))
+generation = next(generations)
+
+
+# Maximum number of database sets kept open, so that switching between
+# projects does not attach all their databases again.
+MAX_OPEN_DATABASES = 4
+
+# (paths, readonly indices, snapshot keys) -> SymbolDatabase.
+open_databases = {}
+# Keys of open_databases, least recently used first (db is the last).
+open_database_keys = []
+
 
-def set_databases(paths):
+def set_databases(paths, readonly=(), snapshot_keys=None):
+    ''' Use databases at given paths. Databases with indices in readonly are
+    snapshots, which are never modified. Snapshot keys are checked when
+    snapshots are attached (see SymbolDatabase). Snapshots that cannot be
+    used are replaced by empty databases, returns list of errors describing
+    them.
+    '''
     global db
-    db = SymbolDatabase(paths)
+    snapshot_keys = snapshot_keys or {}
+    key = tuple(paths), frozenset(readonly), frozenset(snapshot_keys.items())
+    if db is not None:
+        if open_databases.get(key) is db:
+            return db.errors
+        # Do not lose work of an indexing task interrupted by a query to other
+        # databases.
+        db.commit()
+
+    db = open_databases.get(key)
+    if db is None:
+        db = open_databases[key] = SymbolDatabase(paths, readonly,
+                                                  snapshot_keys=snapshot_keys)
+    else:
+        open_database_keys.remove(key)
+    open_database_keys.append(key)
+    if len(open_database_keys) > MAX_OPEN_DATABASES:
+        open_databases.pop(open_database_keys.pop(0)).close()
+    return db.errors
+
+
+def get_attached(path):
+    ''' Return (SymbolDatabase, database index) pairs of open databases with
+    the given file attached.
+    '''
+    return [(open_db, dbi) for open_db in open_databases.itervalues()
+            for dbi, open_path in enumerate(open_db.paths) if open_path == path]
 
 
-def begin_file_processing(dbi):
-    db.begin_file_processing(dbi)
+def check_writable(dbi):
+    if dbi in db.readonly:
+        raise ValueError('Database {0} is read-only'.format(db.paths[dbi]))
 
 
-def end_file_processing(dbi):
-    db.end_file_processing(dbi)
+rebuilds = {}  # Database path -> SymbolDatabase being built to replace it.
 
 
-def process_file(dbi, path):
-    path = os.path.normcase(os.path.normpath(path))
-    if db.update_file_time(dbi, path, os.path.getmtime(path)):
-        db.clear_file(dbi, path)
+def get_target(dbi):
+    ''' Return SymbolDatabase and database index that changes to dbi-th
+    database should be written to (it's different while the database is being
+    rebuilt).
+    '''
+    check_writable(dbi)
+    rebuilt_db = rebuilds.get(db.paths[dbi])
+    if rebuilt_db is None:
+        return db, dbi
+    else:
+        return rebuilt_db, 0
+
+
+def begin_rebuild(dbi):
+    ''' Start building dbi-th database from scratch in a new file. Until
+    finish_rebuild is called, changes go to the new file and queries use the
+    old one.
+    '''
+    check_writable(dbi)
+    path = db.paths[dbi]
+    abort_rebuild(dbi)
+    rebuilt_path = path + '.rebuild'
+    try:
+        os.remove(rebuilt_path)
+    except OSError:
+        # Left over only if the last rebuild crashed.
+        pass
+    rebuilds[path] = SymbolDatabase([rebuilt_path], bulk=True)
+
+
+def finish_rebuild(dbi):
+    ''' Replace dbi-th database with the rebuilt one. Returns new generation,
+    None if the database is not being rebuilt (eg. this process was restarted
+    since begin_rebuild).
+    '''
+    path = db.paths[dbi]
+    rebuilt_db = rebuilds.pop(path, None)
+    if rebuilt_db is None:
+        return None
+    rebuilt_db.commit()
+    rebuilt_db.close()
+
+    package_resolvers.clear()
+    # All connections to the old file must be closed, otherwise its
+    # write-ahead log could be applied to the new one.
+    with watcher_paused(path) as watcher:
+        if watcher is not None:
+            watcher.reopen = True
+        attached = get_attached(path)
+        for open_db, open_dbi in attached:
+            open_db.commit()
+            open_db.detach(open_dbi)
         try:
-            file_ast = ast.parse(open(path).read(), path)
-        except:
-            return False
-        SymbolExtractor(db, dbi, path).visit(file_ast)
-        return True
+            if os.name == 'nt' and os.path.exists(path):
+                # Windows can't rename over an existing file.
+                os.remove(path)
+            os.rename(rebuilt_db.paths[0], path)
+        finally:
+            for open_db, open_dbi in attached:
+                open_db.attach(open_dbi)
+
+    database_changed()
+    return generation
+
+
+def abort_rebuild(dbi):
+    rebuilt_db = rebuilds.pop(db.paths[dbi], None)
+    if rebuilt_db is not None:
+        rebuilt_db.close()
+        os.remove(rebuilt_db.paths[0])
+
+
+# Database path -> PackageResolver filled by the last scan_roots, used until
+# the next commit.
+package_resolvers = {}
+
+
+def get_package_resolver(dbi, roots, namespace_packages):
+    path = db.paths[dbi]
+    packages = package_resolvers.get(path)
+    if packages is None:
+        packages = package_resolvers[path] = PackageResolver(
+            roots, namespace_packages)
+    return packages
+
+
+def process_file(dbi, path, roots=(), namespace_packages=False):
+    return bool(process_files(dbi, [path], roots, namespace_packages))
+
+
+# (files, results) of files passed as next_paths to process_files, see
+# index_files.
+parsed_ahead = None
+
+
+def process_files(dbi, paths, roots=(), namespace_packages=False,
+                  next_paths=(), rebuild=False):
+    ''' Index given files. Roots are needed only if namespace packages are
+    enabled. Next paths (to be passed to the following call) are handed to
+    the parser pool too, so that they're parsed while these are written.
+    If rebuild is set, files are indexed only if the database is being
+    rebuilt, returns None otherwise (see finish_rebuild). Rebuild is aborted
+    if it fails.
+    '''
+    global parsed_ahead
+    if rebuild and db.paths[dbi] not in rebuilds:
+        return None
+    packages = get_package_resolver(dbi, roots, namespace_packages)
+    target_db, target_dbi = get_target(dbi)
+    parsed, parsed_ahead = parsed_ahead, None
+    try:
+        if next_paths:
+            if parsed is None:
+                # Queue these files before the next ones.
+                files = get_changed_files(target_db, target_dbi, paths)
+                parsed = files, parse_changed_files(files)
+            next_files = get_changed_files(target_db, target_dbi, next_paths)
+            parsed_ahead = next_files, parse_changed_files(next_files)
+        return index_files(target_db, target_dbi, paths, packages, parsed)
+    except sqlite3.OperationalError:
+        target_db.rollback()
+        if target_db is not db:
+            # Files of previous batches were rolled back too, the rebuilt
+            # database would be incomplete.
+            abort_rebuild(dbi)
+            if rebuild:
+                return None
+        # Eg. database is locked by another process, files are indexed by the
+        # next update.
+        return []
+
+
+def scan_roots(dbi, roots, pattern=None, exclude=(), follow_symlinks=False,
+               namespace_packages=False):
+    package_resolvers.pop(db.paths[dbi], None)
+    packages = get_package_resolver(dbi, roots, namespace_packages)
+    target_db, dbi = get_target(dbi)
+    try:
+        return find_changed_files(target_db, dbi, roots, pattern, exclude,
+                                  follow_symlinks, packages)
+    except sqlite3.OperationalError:
+        # Removed files could not be deleted, database is locked by another
+        # process. Try again with the next update.
+        target_db.rollback()
+        return []
+
+
+watchers = {}  # Database path -> Watcher.
+
+
+@contextmanager
+def watcher_paused(path):
+    ''' Keep watcher of a database from using it. Yields the Watcher, or None
+    if the database is not watched.
+    '''
+    watcher = watchers.get(path)
+    if watcher is None:
+        yield None
     else:
+        with watcher.lock:
+            yield watcher
+
+
+def watch(dbi, roots, pattern=None, exclude=(), follow_symlinks=False,
+          namespace_packages=False):
+    ''' Start indexing files under roots as soon as they change, in
+    background. Watching the same database again adds roots to watch. Returns
+    False if watching is not supported on this platform.
+    '''
+    if Inotify is None:
         return False
 
+    check_writable(dbi)
+    path = db.paths[dbi]
+    watcher = watchers.get(path)
+    if watcher is None or not watcher.is_alive():
+        watcher = watchers[path] = Watcher(path, pattern, exclude,
+                                           follow_symlinks, namespace_packages)
+        watcher.start()
+    watcher.add_roots(roots)
+    return True
+
+
+@atexit.register
+def stop_watchers():
+    ''' Stop watchers before the interpreter tears down modules they use. '''
+    for watcher in watchers.values():
+        watcher.stop()
+
+
+def get_watch_errors():
+    ''' Return errors of watchers (eg. when the watch limit was reached) that
+    were not returned yet.
+    '''
+    errors = []
+    for watcher in watchers.values():
+        error, watcher.error = watcher.error, None
+        if error is not None:
+            errors.append(error)
+    return errors
+
+
+def set_profiling(enabled):
+    ''' Start or stop collecting timings reported by profiling_report. '''
+    global profiler
+    if not enabled:
+        profiler = None
+    elif profiler is None:
+        profiler = Profiler()
+    for open_db in open_databases.itervalues():
+        open_db.cur = open_db.cursor()
+
+
+def profiling_report(limit):
+    ''' Return slowest queries and files (see Profiler.report), None if
+    profiling is disabled.
+    '''
+    current_profiler = profiler
+    if current_profiler is None:
+        return None
+    return current_profiler.report(limit)
+
 
 def query_occurrences(symbol):
     return list(db.occurrences(symbol))
 
 
+# Maximum number of paged query results kept for further pages.
+MAX_RESULT_CURSORS = 8
+
+result_cursors = {}  # Cursor -> remaining results.
+cursor_ids = count()
+
+
+def query_occurrences_page(symbol, limit, file_name=None, project_folders=()):
+    ''' Same as query_occurrences, but results are (symbol, path, row, col,
+    scope, package) tuples ranked by rank_occurrences. Returns a list of at
+    most limit results and a cursor to be passed to fetch_occurrences_page
+    for the next page (None if there are no more results).
+    '''
+    rows = rank_occurrences(db.occurrence_rows(symbol), file_name,
+                            project_folders)
+    return page_results(rows, limit)
+
+
+def fetch_occurrences_page(cursor, limit):
+    return page_results(result_cursors.pop(cursor, []), limit)
+
+
+def page_results(rows, limit):
+    if len(rows) <= limit:
+        return rows, None
+
+    cursor = next(cursor_ids)
+    result_cursors[cursor] = rows[limit:]
+    if len(result_cursors) > MAX_RESULT_CURSORS:
+        # Cursors are increasing, drop the oldest.
+        del result_cursors[min(result_cursors)]
+    return rows[:limit], cursor
+
+
 def query_members(package, prefix):
     return list(db.members(package, prefix))
 
@@ -325,5 +2112,98 @@ def query_packages(prefix):
     return list(db.packages(prefix))
 
 
+def query_package_components(prefix):
+    if db.generation != generation:
+        # Databases were changed by a watcher or while other databases were
+        # used.
+        db.package_trie = None
+        db.generation = generation
+    return db.package_components(prefix)
+
+
+# Seconds after which maintain does its work again on the same database.
+MAINTENANCE_INTERVAL = 60 * 60
+
+maintenance_times = {}  # Database path -> time of last maintenance.
+
+
+def maintain(force=False):
+    ''' Maintain databases in use (see SymbolDatabase.maintain), unless it was
+    done in the last MAINTENANCE_INTERVAL seconds. Meant to be called when
+    the user is idle. Returns list of maintained database paths.
+    '''
+    db.commit()
+    maintained = []
+    for dbi, path in enumerate(db.paths):
+        if dbi in db.readonly or path in rebuilds or not force and \
+                time() - maintenance_times.get(path, 0) < MAINTENANCE_INTERVAL:
+            continue
+
+        with watcher_paused(path):
+            try:
+                db.maintain(dbi)
+            except sqlite3.OperationalError:
+                # Database is locked by another process, try next time.
+                db.rollback()
+                continue
+            finally:
+                # Strings cached by other connections might have been removed.
+                for open_db, open_dbi in get_attached(path):
+                    open_db.clear_interned(open_dbi)
+        maintenance_times[path] = time()
+        maintained.append(path)
+    return maintained
+
+
+def storage_stats():
+    ''' Return list of SymbolDatabase.storage_stats dicts of databases in
+    use.
+    '''
+    return [db.storage_stats(dbi) for dbi in xrange(db.database_count)]
+
+
+def get_generation():
+    return generation
+
+
 def commit():
+    ''' Commit changes, returns new generation. '''
+    global generation
     db.commit()
+    # Packages may change before the next scan (eg. new __init__.py files).
+    package_resolvers.clear()
+    generation = next(generations)
+    return generation
+
+
+def main():
+    import argparse
+
+    parser = argparse.ArgumentParser(
+        description='Export a database as a read-only snapshot.')
+    parser.add_argument('source', help='database to export')
+    parser.add_argument('destination',
+                        help='snapshot path, may contain {python_version} and '
+                        '{lockfile_hash} placeholders')
+    parser.add_argument('--python-version',
+                        default='{0}.{1}'.format(*sys.version_info[:2]),
+                        help='version of Python whose files were indexed '
+                        '(defaults to the one running this script)')
+    parser.add_argument('--lockfile',
+                        help='file pinning versions of indexed packages (eg. '
+                        'requirements.txt)')
+    args = parser.parse_args()
+
+    lockfile_hash = ''
+    if args.lockfile is not None:
+        with open(args.lockfile, 'rb') as f:
+            lockfile_hash = sha1(f.read()).hexdigest()
+    destination = args.destination.format(python_version=args.python_version,
+                                          lockfile_hash=lockfile_hash)
+    export_snapshot(args.source, destination, args.python_version,
+                    lockfile_hash)
+    print destination
+
+
+if __name__ == '__main__':
+    main()
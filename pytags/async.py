@@ -1,10 +1,18 @@
-from Queue import Empty, Queue
+from Queue import Empty, PriorityQueue
 from functools import partial
+from itertools import count
 from threading import Event, Lock, Thread
 
 from sublime import set_timeout
 
 
+# Priorities of calls posted to WorkerThread. Calls with lower values are
+# executed first, calls with equal priorities in the order they were posted.
+PRIORITY_INTERACTIVE = 0  # User is waiting for the result.
+PRIORITY_NORMAL = 1
+PRIORITY_BACKGROUND = 2  # Long running tasks, like building the index.
+
+
 class AsyncResult(object):
     result = None
     failed = None
@@ -39,13 +47,15 @@ class WorkerThread(object):
 
     def __init__(self, timeout=5):
         self.timeout = timeout
-        self.queue = Queue()
+        self.queue = PriorityQueue()
         self.lock = Lock()
+        self.sequence = count()
 
     def main(self):
         while True:
             try:
-                f, result = self.queue.get(True, self.timeout)
+                priority, sequence, f, result = self.queue.get(True,
+                                                               self.timeout)
             except Empty:
                 # Time to clean up this thread, make sure not to miss anything.
                 with self.lock:
@@ -63,11 +73,13 @@ class WorkerThread(object):
     def call(self, _f, *args, **kwargs):
         ''' Execute _f(*args, **kwargs) in a worker thread associated with this
         object. Returns AsyncResult which can be used to wait for posted call
-        to complete and get its result.
+        to complete and get its result. Call priority can be passed as
+        _priority keyword argument (PRIORITY_NORMAL by default).
         '''
 
         # Prepare request.
         forget = kwargs.pop('_forget', False)
+        priority = kwargs.pop('_priority', PRIORITY_NORMAL)
         _f = partial(_f, *args, **kwargs)
         if forget:
             result = None
@@ -76,7 +88,7 @@ class WorkerThread(object):
 
         # Post the request.
         with self.lock:
-            self.queue.put((_f, result))
+            self.queue.put((priority, next(self.sequence), _f, result))
 
             # If there was no thread to handle the request (the last one timed
             # out or exited abnormally) than create a new one.
@@ -91,6 +103,25 @@ class WorkerThread(object):
         kwargs['_forget'] = True
         self.call(_f, *args, **kwargs)
 
+    def schedule_task(self, _f, *args, **kwargs):
+        ''' Schedule a long running task. _f(*args, **kwargs) must return an
+        iterator (eg. _f may be a generator function), which is advanced step
+        by step. After each step calls posted in the meantime with higher (or
+        equal) priority are executed. Default priority is PRIORITY_BACKGROUND.
+        '''
+        priority = kwargs.pop('_priority', PRIORITY_BACKGROUND)
+        task = _f(*args, **kwargs)
+
+        def step():
+            try:
+                next(task)
+            except StopIteration:
+                pass
+            else:
+                self.schedule(step, _priority=priority)
+
+        self.schedule(step, _priority=priority)
+
 
 # Default worker thread.
 async_worker = WorkerThread()
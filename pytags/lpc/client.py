@@ -2,9 +2,15 @@ import cPickle as pickle
 import os
 import os.path
 
+from bisect import bisect_left
+from functools import partial
+from itertools import izip
 from subprocess import PIPE, Popen
+from threading import Thread
 from time import time
 
+from pytags.lpc.wire import HANDSHAKE, VERSION as WIRE_VERSION, read_reply
+
 
 # For debugging. Set to True from Python console to enable logging all LPC
 # calls to stdout.
@@ -19,11 +25,59 @@ PICKLE_PROTOCOL = 2
 SERVER_PATH = os.path.abspath(os.path.join(os.path.dirname(__file__),
                                            'server.py'))
 
+# Pipelined requests up to this size are written without a helper thread, as
+# they fit in pipe buffer on any platform.
+PIPE_BUFFER_SIZE = 4096
+
+
+# Upper bounds (in seconds) of LPC latency histogram buckets. Calls slower than
+# the last one fall into an extra bucket.
+LATENCY_BUCKETS = (0.001, 0.002, 0.005, 0.01, 0.02, 0.05, 0.1, 0.2, 0.5, 1, 2,
+                   5)
+
 
 class LPCError(Exception):
     pass
 
 
+class CallStats(object):
+    ''' Latencies and payload sizes of calls to a single LPC. '''
+
+    def __init__(self):
+        self.count = 0
+        self.total_time = 0
+        self.max_time = 0
+        self.sent = 0      # Total size of pickled requests.
+        self.received = 0  # Total size of replies.
+        self.histogram = [0] * (len(LATENCY_BUCKETS) + 1)
+
+    def add(self, elapsed, sent, received):
+        self.count += 1
+        self.total_time += elapsed
+        self.max_time = max(self.max_time, elapsed)
+        self.sent += sent
+        self.received += received
+        self.histogram[bisect_left(LATENCY_BUCKETS, elapsed)] += 1
+
+
+class CountingReader(object):
+    ''' Wraps a file to count bytes read by pickle.load. '''
+
+    def __init__(self, f):
+        self.f = f
+        self.count = 0
+
+    def read(self, size=-1):
+        data = self.f.read(size)
+        self.count += len(data)
+        return data
+
+    def readline(self):
+        data = self.f.readline()
+        self.count += len(data)
+        return data
+
+
 class FunctionProxy(object):
     def __init__(self, client, name):
         self.client = client
@@ -33,12 +87,50 @@ class FunctionProxy(object):
         return self.client._call(self.name, *args, **kwargs)
 
 
+class LPCBatch(object):
+    ''' Collects calls to be sent to LPC server at once, without waiting for
+    replies in between. Use as a context manager:
+
+        with client._batch() as batch:
+            batch.foo(1)
+            batch.bar(2)
+        foo_result, bar_result = batch.results
+    '''
+
+    results = None
+
+    def __init__(self, client):
+        self._client = client
+        self._calls = []
+
+    def _add(self, _name, *args, **kwargs):
+        self._calls.append((_name, args, kwargs))
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        return partial(self._add, name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        if exc_type is None:
+            self.results = self._client._call_many(self._calls)
+
+
 class LPCClient(object):
     _process = None
     _error = None
+    _stats = None  # LPC name -> CallStats, if profiling is enabled.
+    _wire_version = None  # Negotiated wire format, None for plain pickles.
 
-    def __init__(self, module, python='python'):
+    def __init__(self, module, python='python', compact=True):
+        ''' If compact is True, the server is asked to send replies in
+        compact wire format (see wire module).
+        '''
         self._args = [python, '-u', SERVER_PATH, module]
+        self._compact = compact
 
     def _startup(self):
         if self._error is not None:
@@ -54,6 +146,17 @@ class LPCClient(object):
             # reasons).
             self._process = Popen(args=self._args, stdin=PIPE, stdout=PIPE,
                                   stderr=PIPE)
+            if self._compact:
+                self._negotiate()
+
+    def _negotiate(self):
+        request = pickle.dumps((HANDSHAKE, (WIRE_VERSION,), {}),
+                               PICKLE_PROTOCOL)
+        try:
+            self._process.stdin.write(request)
+            self._wire_version = pickle.load(self._process.stdout)
+        except (IOError, EOFError, pickle.UnpicklingError) as e:
+            self._fail(e)
 
     def _cleanup(self, error=None):
         if self._process is None:
@@ -67,6 +170,7 @@ class LPCClient(object):
         self._process.stderr.close()
         self._process.wait()
         self._process = None
+        self._wire_version = None
         self._error = error
 
     def _call(self, _name, *args, **kwargs):
@@ -80,22 +184,130 @@ class LPCClient(object):
                                           ', '.join(repr(a) for a in args)),
             begin_time = time()
 
+        stats = self._stats
         try:
-            pickle.dump((_name, args, kwargs), self._process.stdin,
-                        PICKLE_PROTOCOL)
-            ret = pickle.load(self._process.stdout)
+            request = pickle.dumps((_name, args, kwargs), PICKLE_PROTOCOL)
+            call_time = time()
+            self._process.stdin.write(request)
+            ret, size = self._read_reply()
+            if stats is not None:
+                self._record(stats, _name, time() - call_time, len(request),
+                             size)
 
             if LOG_LPC:
                 print '= {0!r} ({1:.3f}s)'.format(ret, time() - begin_time)
 
             return ret
         except (IOError, EOFError, pickle.UnpicklingError) as e:
-            if LOG_LPC:
-                print '! {0}'.format(e)
+            self._fail(e)
+
+    def _call_many(self, calls):
+        ''' Execute multiple calls given as (name, args, kwargs) tuples. All
+        requests are sent upfront and replies are collected afterwards, so the
+        whole batch costs a single round trip. Returns list of results.
+        '''
+        self._startup()
+
+        if LOG_LPC:
+            print '[LPC] {0} batched calls'.format(len(calls)),
+            begin_time = time()
+
+        stats = self._stats
+        requests = [pickle.dumps(call, PICKLE_PROTOCOL) for call in calls]
+        if stats is not None:
+            request_sizes = map(len, requests)
+            call_time = time()
+        requests = ''.join(requests)
+        if len(requests) <= PIPE_BUFFER_SIZE:
+            writer = None
+            self._write_requests(requests)
+        else:
+            # Server writes replies while requests are still being sent. Read
+            # them concurrently, otherwise both pipes may fill up and deadlock.
+            writer = Thread(target=self._write_requests, args=(requests,))
+            writer.start()
+
+        try:
+            if stats is None:
+                ret = [self._read_reply()[0] for call in calls]
+            else:
+                # Calls are executed one after another, so time between
+                # replies approximates time spent on each call.
+                ret = []
+                for call, request_size in izip(calls, request_sizes):
+                    reply, size = self._read_reply()
+                    ret.append(reply)
+                    reply_time = time()
+                    self._record(stats, call[0], reply_time - call_time,
+                                 request_size, size)
+                    call_time = reply_time
+        except (IOError, EOFError, pickle.UnpicklingError) as e:
+            if writer is not None:
+                writer.join()
+            self._fail(e)
+
+        if writer is not None:
+            writer.join()
+
+        if LOG_LPC:
+            print '= {0!r} ({1:.3f}s)'.format(ret, time() - begin_time)
+
+        return ret
+
+    def _read_reply(self):
+        ''' Read reply to the next request. Returns the reply and its size
+        (None if it was not counted).
+        '''
+        if self._wire_version is not None:
+            return read_reply(self._process.stdout)
+        elif self._stats is None:
+            return pickle.load(self._process.stdout), None
+        reader = CountingReader(self._process.stdout)
+        return pickle.load(reader), reader.count
+
+    def _write_requests(self, requests):
+        try:
+            self._process.stdin.write(requests)
+        except IOError:
+            # Server died, reading replies will fail and report the error.
+            pass
+
+    def _batch(self):
+        return LPCBatch(self)
+
+    def _set_profiling(self, enabled):
+        ''' Start or stop collecting statistics of calls made by this client
+        (available through _profiling_report). Statistics are reset when
+        profiling is stopped.
+        '''
+        if not enabled:
+            self._stats = None
+        elif self._stats is None:
+            self._stats = {}
+
+    def _profiling_report(self):
+        ''' Return list of (LPC name, CallStats) pairs, sorted by total time
+        spent in each LPC, or None if profiling is disabled.
+        '''
+        if self._stats is None:
+            return None
+        return sorted(self._stats.items(), key=lambda item: item[1].total_time,
+                      reverse=True)
+
+    def _record(self, stats, name, elapsed, sent, received):
+        try:
+            call_stats = stats[name]
+        except KeyError:
+            call_stats = stats[name] = CallStats()
+        call_stats.add(elapsed, sent, received)
+
+    def _fail(self, e):
+        if LOG_LPC:
+            print '! {0}'.format(e)
 
-            e = LPCError(self._process.stderr.read())
-            self._cleanup(e)
-            raise e
+        e = LPCError(self._process.stderr.read())
+        self._cleanup(e)
+        raise e
 
     def __getattr__(self, name):
         if name.startswith('_'):
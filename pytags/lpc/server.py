@@ -1,27 +1,54 @@
 import cPickle as pickle
+import io
+import os.path
+import sys
 
-from imp import load_source
 from sys import argv, stdin, stdout
 
+from wire import HANDSHAKE, encode_reply, negotiate
+
 
 # This module is handles data pickled by different Python version, so use
 # explicit protocol number.
 PICKLE_PROTOCOL = 2
 
 
+def load_module(path):
+    # Import the module by name rather than by path, so that its functions can
+    # be pickled (eg. when handed over to multiprocessing workers).
+    module_dir, module_name = os.path.split(os.path.splitext(path)[0])
+    sys.path.insert(0, module_dir)
+    return __import__(module_name)
+
+
 def main():
     if len(argv) != 2:
         raise ValueError('Need exactly 1 argument (module)')
 
-    module = load_source('external_module', argv[1])
+    module = load_module(argv[1])
+
+    # cPickle reads real files without releasing GIL, which would block
+    # background threads of the module while waiting for requests.
+    requests = io.open(stdin.fileno(), 'rb', closefd=False)
 
+    wire_version = None
     while True:
         try:
-            cmd = pickle.load(stdin)
+            cmd = pickle.load(requests)
         except EOFError:
             break
-        handler = getattr(module, cmd[0])
-        pickle.dump(handler(*cmd[1], **cmd[2]), stdout, PICKLE_PROTOCOL)
+        if cmd[0] == HANDSHAKE:
+            reply = negotiate(*cmd[1])
+        else:
+            reply = getattr(module, cmd[0])(*cmd[1], **cmd[2])
+
+        # Each reply is written at once, stdout is unbuffered.
+        if wire_version is None:
+            stdout.write(pickle.dumps(reply, PICKLE_PROTOCOL))
+        else:
+            stdout.write(encode_reply(reply))
+        if cmd[0] == HANDSHAKE:
+            wire_version = reply
 
 
 if __name__ == '__main__':
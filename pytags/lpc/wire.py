@@ -0,0 +1,228 @@
+''' Compact encoding of LPC replies. Imported both by the client (running in
+Sublime's embedded Python 2.6) and by the server, so it must not depend on
+anything newer.
+
+After negotiation (see HANDSHAKE), every reply is sent as a frame: a header
+with payload format and length, followed by the payload. Frames are written
+with a single call, while pickle.dump writes each opcode separately to the
+unbuffered pipe. Small replies are plainly pickled. Large lists (query
+results) are packed first: lists of tuples or dicts are split into columns,
+with integers stored in arrays and strings joined into a single string. Packed
+replies unpickle into a handful of large strings instead of thousands of small
+objects, and are rebuilt with C-level split, map and zip calls.
+'''
+
+import cPickle as pickle
+
+from array import array
+from itertools import imap, izip, repeat
+from operator import itemgetter
+from struct import Struct
+
+
+# Replies are unpickled by a different Python version, so use explicit protocol
+# number.
+PICKLE_PROTOCOL = 2
+
+# Latest version of the wire format.
+VERSION = 1
+
+# Name of the request negotiating the wire format. It takes the latest version
+# supported by the client, the server replies with version to be used for
+# following replies (pickled, as any reply to requests that came before).
+HANDSHAKE = '_wire_handshake'
+
+# Payload format (PICKLED or PACKED) and length.
+FRAME_HEADER = Struct('<cI')
+PICKLED = 'P'
+PACKED = 'C'
+
+# Shorter lists are pickled as they are.
+PACK_MIN_ITEMS = 32
+
+# Typecode of integer arrays.
+INT_ARRAY = 'i'
+
+# Packed values are (tag, ...) tuples, see pack.
+VALUE, TUPLE, STRINGS, ROWS, DICTS = range(5)
+
+# Packed columns of ROWS and DICTS.
+COLUMN_VALUES, COLUMN_INTS, COLUMN_STRINGS, COLUMN_INDEXED = range(4)
+
+STRING_TYPES = (str, unicode)
+SEPARATORS = {str: '\0', unicode: u'\0'}
+
+
+def negotiate(version):
+    ''' Return wire format version to be used with a client supporting given
+    version.
+    '''
+    return min(version, VERSION)
+
+
+class Unpackable(Exception):
+    pass
+
+
+def join_strings(strings, kind):
+    ''' Join strings of type STRING_TYPES[kind] into a single byte string.
+    '''
+    separator = SEPARATORS[STRING_TYPES[kind]]
+    joined = separator.join(strings)
+    if strings and joined.count(separator) != len(strings) - 1:
+        raise Unpackable('Separator in a string')
+    if kind:
+        joined = joined.encode('utf-8')
+    return joined, len(strings)
+
+
+def split_strings(joined, count, kind):
+    ''' Reverse join_strings. '''
+    if not count:
+        return []
+    if kind:
+        joined = joined.decode('utf-8')
+    return joined.split(SEPARATORS[STRING_TYPES[kind]])
+
+
+def to_ints(values):
+    try:
+        return array(INT_ARRAY, values).tostring()
+    except OverflowError:
+        raise Unpackable('Integer out of range')
+
+
+def from_ints(data):
+    values = array(INT_ARRAY)
+    values.fromstring(data)
+    return values
+
+
+def get_type(values):
+    ''' Return type of all values, None if they differ. '''
+    types = set(imap(type, values))
+    if len(types) == 1:
+        return types.pop()
+    return None
+
+
+def pack(value):
+    ''' Return packed value, or (VALUE, value) if packing does not pay off.
+    Lists of strings are joined and lists of tuples or dicts (with the same
+    length or keys) are split into columns, see pack_column.
+    '''
+    value_type = type(value)
+    if value_type is tuple:
+        items = map(pack, value)
+        if all(item[0] == VALUE for item in items):
+            return VALUE, value
+        return TUPLE, items
+    if value_type is not list or len(value) < PACK_MIN_ITEMS:
+        return VALUE, value
+
+    item_type = get_type(value)
+    if item_type in STRING_TYPES:
+        return (STRINGS, STRING_TYPES.index(item_type)) + \
+            join_strings(value, STRING_TYPES.index(item_type))
+    if item_type not in (tuple, dict) or len(set(imap(len, value))) != 1:
+        return VALUE, value
+
+    if item_type is tuple and value[0]:
+        return ROWS, map(pack_column, izip(*value))
+    if item_type is dict and len(value[0]) > 1:
+        keys = value[0].keys()
+        try:
+            rows = map(itemgetter(*keys), value)
+        except KeyError:
+            return VALUE, value
+        return DICTS, keys, map(pack_column, izip(*rows))
+    return VALUE, value
+
+
+def pack_column(column):
+    ''' Integers are stored in an array. Strings are joined, or if most of
+    them repeat (eg. scopes or packages of query results), replaced with
+    indexes into a table of distinct ones.
+    '''
+    column_type = get_type(column)
+    if column_type is int:
+        try:
+            return COLUMN_INTS, to_ints(column)
+        except Unpackable:
+            pass
+    elif column_type in STRING_TYPES:
+        kind = STRING_TYPES.index(column_type)
+        strings = list(set(column))
+        if len(strings) * 2 > len(column):
+            return (COLUMN_STRINGS, kind) + join_strings(column, kind)
+        indexes = dict(izip(strings, xrange(len(strings))))
+        return (COLUMN_INDEXED, kind) + join_strings(strings, kind) + \
+            (to_ints(map(indexes.__getitem__, column)),)
+    return COLUMN_VALUES, list(column)
+
+
+def unpack(packed):
+    ''' Reverse pack. '''
+    tag = packed[0]
+    if tag == VALUE:
+        return packed[1]
+    elif tag == TUPLE:
+        return tuple(map(unpack, packed[1]))
+    elif tag == STRINGS:
+        return split_strings(packed[2], packed[3], packed[1])
+    elif tag == ROWS:
+        return zip(*map(unpack_column, packed[1]))
+    elif tag == DICTS:
+        rows = izip(*map(unpack_column, packed[2]))
+        return map(dict, imap(izip, repeat(packed[1]), rows))
+    raise pickle.UnpicklingError('Unknown packed value: {0!r}'.format(tag))
+
+
+def unpack_column(column):
+    tag = column[0]
+    if tag == COLUMN_VALUES:
+        return column[1]
+    elif tag == COLUMN_INTS:
+        return from_ints(column[1])
+    elif tag == COLUMN_STRINGS:
+        return split_strings(column[2], column[3], column[1])
+    elif tag == COLUMN_INDEXED:
+        strings = split_strings(column[2], column[3], column[1])
+        return map(strings.__getitem__, from_ints(column[4]))
+    raise pickle.UnpicklingError('Unknown packed column: {0!r}'.format(tag))
+
+
+def encode_reply(value):
+    ''' Return frame with given reply. '''
+    try:
+        packed = pack(value)
+    except Unpackable:
+        packed = VALUE, value
+
+    if packed[0] == VALUE:
+        payload_format = PICKLED
+        payload = pickle.dumps(value, PICKLE_PROTOCOL)
+    else:
+        payload_format = PACKED
+        payload = pickle.dumps(packed, PICKLE_PROTOCOL)
+    return FRAME_HEADER.pack(payload_format, len(payload)) + payload
+
+
+def read_reply(f):
+    ''' Read a frame from file, returns reply and frame size. '''
+    header = f.read(FRAME_HEADER.size)
+    if len(header) < FRAME_HEADER.size:
+        raise EOFError
+    payload_format, size = FRAME_HEADER.unpack(header)
+    payload = f.read(size)
+    if len(payload) < size:
+        raise EOFError
+
+    if payload_format == PICKLED:
+        reply = pickle.loads(payload)
+    elif payload_format == PACKED:
+        reply = unpack(pickle.loads(payload))
+    else:
+        raise pickle.UnpicklingError('Unknown payload format: {0!r}'.format(
+            payload_format))
+    return reply, FRAME_HEADER.size + size